@@ -0,0 +1,62 @@
+import asyncio
+
+
+class WriteBatcher:
+    '''
+    合并并发的单条写入：等待最多max_delay秒或凑满max_size条后，调用一次flush_func批量写入
+    flush_func(items) -> list，与items一一对应，元素为该条的结果或异常，每个调用方只得到自己的结果
+    '''
+    def __init__(self, flush_func, max_delay=0.002, max_size=100, **kwargs):
+        self.flush_func = flush_func
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.pending = []           # [(item, future), ...]
+        self.timer = None
+        self.tasks = set()          # 持有正在执行的flush任务的引用
+        self.batches = 0
+        self.items = 0
+
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self.flush)
+        return await future
+
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self.run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+
+    async def run(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self.flush_func([item for item, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():   # 调用方已取消（如客户端断开），数据仍会写入
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+    def get_stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'items': self.items,
+        }
@@ -0,0 +1,56 @@
+'''
+重复上传同一文件时，普通上传与去重上传的耗时和占用空间对比，需要可用的minio
+
+python -m maple_api.benchmarks.bench_dedup_upload --url 127.0.0.1:9090 --bucket test
+'''
+import argparse
+import io
+import os
+import time
+from uuid import uuid4
+
+from ..storage_minio import MinioAdapter
+
+
+def bench(sto_adapter, content, uploads):
+    prefix = f'bench_dedup_upload/{uuid4()}'
+    costs = []
+    for _ in range(uploads):
+        start = time.perf_counter()
+        sto_adapter.upload_object(io.BytesIO(content), prefix=prefix, file_name='bench.bin')
+        costs.append(time.perf_counter() - start)
+
+    objects = list(sto_adapter.client.list_objects(sto_adapter.bucket, prefix=prefix + '/', recursive=True))
+    stored = sum(o.size for o in objects)
+    for o in objects:
+        sto_adapter.remove_object(o.object_name)
+    duplicate_cost = sum(costs[1:]) / max(len(costs) - 1, 1)
+    return costs[0], duplicate_cost, stored
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='127.0.0.1:9090')
+    parser.add_argument('--bucket', default='test')
+    parser.add_argument('--access-key', default='minioadmin')
+    parser.add_argument('--secret-key', default='minioadmin')
+    parser.add_argument('--size', type=int, default=5 * 1024 * 1024)
+    parser.add_argument('--uploads', type=int, default=20)
+    args = parser.parse_args()
+
+    content = os.urandom(args.size)
+    print(f'size={args.size} uploads={args.uploads}')
+    results = {}
+    for dedup in (False, True):
+        sto_adapter = MinioAdapter(
+            args.url, args.bucket, args.access_key, args.secret_key,
+            secure=False, policy=None, dedup=dedup,
+        )
+        results[dedup] = bench(sto_adapter, content, args.uploads)
+        first, duplicate, stored = results[dedup]
+        print(f"{'dedup' if dedup else 'plain':>6}: first {first * 1000:8.1f} ms, duplicate {duplicate * 1000:8.1f} ms, stored {stored / 1024 / 1024:8.1f} MiB")
+    print(f'saved: {(results[False][2] - results[True][2]) / 1024 / 1024:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''
+对比列表接口的默认序列化（response_model校验）和fast_response，不需要数据库
+
+python -m maple_api.benchmarks.bench_serializer --rows 10000
+'''
+import argparse
+import asyncio
+import time
+from datetime import datetime
+from typing import List
+
+from bson import ObjectId
+from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from .. import utils
+from ..serializer import XJSONResponse, FieldSelector
+
+
+class Item(BaseModel):
+    id: int
+    name: str = Field(..., x_out=True)
+    price: float = Field(0, x_out=True)
+    tags: List[str] = Field([], x_out=True)
+    created: datetime = Field(None, x_out=True)
+    owner_id: int = Field(None, x_out=True)
+    description: str = Field('', x_out=True)
+    secret: str = Field('')
+
+
+def build_datas(rows):
+    return [
+        {
+            '_id': ObjectId(),
+            'id': i,
+            'name': f'item{i}',
+            'price': i * 0.5,
+            'tags': ['a', 'b', 'c'],
+            'created': datetime.now(),
+            'owner_id': i % 100,
+            'description': 'x' * 100,
+            'secret': 'secret',
+        }
+        for i in range(rows)
+    ]
+
+
+def bench(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    model_out = utils.build_new_model_from_pydantic_model_by_flag(Item, flag='x_out', suffix='_Out')
+    projection = utils.get_projection_from_pydantic_model(model_out)
+    datas = [{k: v for k, v in d.items() if projection.get(k)} for d in build_datas(args.rows)]
+
+    field = create_response_field(name='response', type_=List[model_out])
+    selector = FieldSelector(model_out)
+
+    def default_path():
+        content = asyncio.run(serialize_response(field=field, response_content=datas))
+        return JSONResponse(content).body
+
+    def fast_path():
+        return XJSONResponse(selector.select(datas)).body
+
+    default_cost = bench(default_path, args.repeat)
+    fast_cost = bench(fast_path, args.repeat)
+    print(f'rows={args.rows}')
+    print(f'response_model: {default_cost * 1000:8.2f} ms')
+    print(f'fast_response:  {fast_cost * 1000:8.2f} ms ({default_cost / fast_cost:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
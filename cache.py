@@ -0,0 +1,265 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+from fnmatch import fnmatch
+from uuid import uuid4
+
+from .serializer import dumps
+
+
+LEASE_TTL = 10      # 读穿填充的租约秒数，持有者异常退出时租约自动过期
+
+
+class CacheBackend:
+    '''
+    缓存后端基类，get未命中时返回None
+    is_blocking为True时（如访问外部缓存），调用方应放入线程池执行
+    读穿填充：未命中时先lease取得租约，读取数据库后用set_leased写入；
+    期间的delete/clear会使租约失效，避免把修改前读到的旧数据写回缓存
+    '''
+    is_blocking = False
+
+    def get(self, key):
+        ...
+
+    def set(self, key, value, ttl=None):
+        ...
+
+    def lease(self, key):
+        '''
+        key不存在时取得租约，返回token；已有数据或租约时返回None
+        '''
+        ...
+
+    def set_leased(self, key, token, value, ttl=None) -> bool:
+        '''
+        租约仍有效时写入，返回是否写入
+        '''
+        ...
+
+    def delete(self, key):
+        ...
+
+    def clear(self):
+        ...
+
+    def get_stats(self) -> dict:
+        ...
+
+
+class _Lease:
+    def __init__(self, token):
+        self.token = token
+
+
+class LRUCache(CacheBackend):
+    '''
+    进程内LRU缓存，超过maxsize时淘汰最久未使用的数据，ttl为默认过期秒数
+    '''
+    def __init__(self, maxsize=1024, ttl=60, **kwargs):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()   # key -> (过期时间, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_item(self, key):
+        item = self.data.get(key)
+        if item is not None and item[0] is not None and item[0] < time.monotonic():
+            del self.data[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self.lock:
+            item = self._get_item(key)
+            if item is None or isinstance(item[1], _Lease):
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def _put(self, key, value, ttl):
+        expire_at = time.monotonic() + ttl if ttl else None
+        self.data[key] = (expire_at, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def lease(self, key):
+        with self.lock:
+            if self._get_item(key) is not None:
+                return None
+            token = uuid4().hex
+            self._put(key, _Lease(token), LEASE_TTL)
+            return token
+
+    def set_leased(self, key, token, value, ttl=None) -> bool:
+        with self.lock:
+            item = self._get_item(key)
+            if item is None or not isinstance(item[1], _Lease) or item[1].token != token:
+                return False
+            self._put(key, value, ttl if ttl is not None else self.ttl)
+            return True
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self._put(key, value, ttl if ttl is not None else self.ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.data),
+        }
+
+
+class ExternalCache(CacheBackend):
+    '''
+    外部缓存（接口与redis-py一致的client），数据以JSON保存，key带prefix前缀
+    淘汰由外部缓存负责，evictions始终为0
+    租约以特殊前缀的值保存在同一个key中，set_leased用脚本原子地比较并写入
+    '''
+    is_blocking = True
+    lease_prefix = b'\x00lease:'
+    set_if_equal_script = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    if tonumber(ARGV[3]) > 0 then
+        redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    else
+        redis.call('set', KEYS[1], ARGV[2])
+    end
+    return 1
+end
+return 0
+'''
+
+    def __init__(self, client, prefix='maple_api:', ttl=60, **kwargs):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.set_if_equal = client.register_script(self.set_if_equal_script)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if isinstance(value, str):
+            value = value.encode()
+        if value is None or value.startswith(self.lease_prefix):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def lease(self, key):
+        token = uuid4().hex
+        if self.client.set(self.prefix + key, self.lease_prefix + token.encode(), ex=LEASE_TTL, nx=True):
+            return token
+        return None
+
+    def set_leased(self, key, token, value, ttl=None) -> bool:
+        ttl = ttl if ttl is not None else self.ttl
+        args = [self.lease_prefix + token.encode(), dumps(value), int(ttl or 0)]
+        return bool(self.set_if_equal(keys=[self.prefix + key], args=args))
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        self.client.set(self.prefix + key, dumps(value), ex=ttl or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def get_stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': 0,
+        }
+
+
+class LocalCacheClient:
+    '''
+    进程内模拟的redis client（get/set/delete/scan_iter/register_script），用于测试ExternalCache
+    register_script只模拟ExternalCache的比较并写入脚本
+    '''
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            return self._get(name)
+
+    def _get(self, name):
+        item = self.data.get(name)
+        if item is None or (item[0] is not None and item[0] < time.monotonic()):
+            self.data.pop(name, None)
+            return None
+        return item[1]
+
+    def set(self, name, value, ex=None, nx=False):
+        with self.lock:
+            if nx and self._get(name) is not None:
+                return None
+            self.data[name] = (time.monotonic() + ex if ex else None, value)
+        return True
+
+    def register_script(self, script):
+        def set_if_equal(keys, args):
+            (name,), (expected, value, ex) = keys, args
+            with self.lock:
+                if self._get(name) != expected:
+                    return 0
+                self.data[name] = (time.monotonic() + ex if ex else None, value)
+            return 1
+        return set_if_equal
+
+    def delete(self, *names):
+        with self.lock:
+            return sum(self.data.pop(name, None) is not None for name in names)
+
+    def scan_iter(self, match='*'):
+        with self.lock:
+            return iter([name for name in self.data if fnmatch(name, match)])
+
+
+def build_cache(cache_conf: dict, prefix: str = '') -> CacheBackend:
+    '''
+    cache_conf: {
+        'name': 'lru',      # lru: 进程内LRU; redis: redis缓存; local: 进程内模拟的外部缓存（测试用）
+        'ttl': 60,          # 过期秒数
+        'maxsize': 1024,    # lru可选
+        'url': '',          # redis可选
+    }
+    '''
+    cache_conf = dict(cache_conf)
+    name = cache_conf.pop('name', 'lru')
+    if name == 'lru':
+        return LRUCache(**cache_conf)
+    elif name == 'redis':
+        import redis
+        client = redis.Redis.from_url(cache_conf.pop('url'))
+        return ExternalCache(client, prefix=f'maple_api:{prefix}', **cache_conf)
+    elif name == 'local':
+        return ExternalCache(LocalCacheClient(), prefix=f'maple_api:{prefix}', **cache_conf)
+    raise ValueError(f'未知的缓存: {name}')
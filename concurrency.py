@@ -0,0 +1,110 @@
+import asyncio
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+_executor = None
+_executor_size = 40     # 与starlette默认的线程数上限保持一致
+
+
+def set_threadpool_size(max_workers: int):
+    '''
+    设置执行同步调用的有界线程池大小（需在处理请求前调用）
+    '''
+    global _executor, _executor_size
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+    _executor_size = max_workers
+
+
+def get_executor() -> ThreadPoolExecutor:
+    '''
+    获取有界线程池，首次使用时创建
+    '''
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_executor_size, thread_name_prefix='maple_api')
+    return _executor
+
+
+async def run_sync(func, *args, **kwargs):
+    '''
+    在有界线程池中执行同步函数，避免阻塞事件循环
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), partial(func, *args, **kwargs))
+
+
+async def call_adapter(adapter, method_name: str, *args, **kwargs):
+    '''
+    调用适配器方法：异步适配器直接await，同步适配器放入线程池执行
+    '''
+    func = getattr(adapter, method_name)
+    if getattr(adapter, 'is_async', False):
+        return await func(*args, **kwargs)
+    return await run_sync(func, *args, **kwargs)
+
+
+async def iterate_adapter(adapter, method_name: str, *args, **kwargs):
+    '''
+    迭代适配器的生成器方法：异步适配器直接async for，同步适配器的每一步放入线程池执行
+    '''
+    gen = getattr(adapter, method_name)(*args, **kwargs)
+    if getattr(adapter, 'is_async', False):
+        async for item in gen:
+            yield item
+    else:
+        end = object()
+        pending = None
+        try:
+            while True:
+                pending = get_executor().submit(next, gen, end)
+                item = await asyncio.wrap_future(pending)
+                if item is end:
+                    break
+                yield item
+        finally:
+            if pending is None:
+                gen.close()
+            else:
+                # 取消（如客户端断开）时线程中的next可能仍在执行，此时close会抛出generator already executing
+                # 因此等这一步结束后再关闭生成器，确保其finally（如归还连接）得到执行；已结束时回调立即执行
+                pending.add_done_callback(lambda _: gen.close())
+
+
+class SingleFlight:
+    '''
+    合并相同key的并发调用：同一时刻只执行一次，其余调用方等待同一结果
+    结果被多个调用方共享时，每个调用方得到各自的深拷贝，避免互相修改
+    '''
+    def __init__(self):
+        self.calls = {}     # key -> [task, 调用方数量]
+        self.flights = 0
+        self.coalesced = 0
+
+
+    async def do(self, key, func, *args, **kwargs):
+        call = self.calls.get(key)
+        if call is None:
+            async def run():
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.calls.pop(key, None)   # 完成后的新调用重新执行，不会读到旧结果
+            call = self.calls[key] = [asyncio.ensure_future(run()), 0]
+            self.flights += 1
+        else:
+            self.coalesced += 1
+        call[1] += 1
+        # shield: 某个调用方被取消（如客户端断开）时不影响其他调用方
+        result = await asyncio.shield(call[0])
+        return copy.deepcopy(result) if call[1] > 1 else result
+
+
+    def get_stats(self) -> dict:
+        return {
+            'flights': self.flights,
+            'coalesced': self.coalesced,
+        }
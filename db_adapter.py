@@ -1,4 +1,7 @@
 class DataBaseAdapter:
+    is_async = False    # 为True时，所有数据读写方法均为协程
+    version_field = None    # 数据的版本号字段，每次修改递增，用于ETag和乐观并发控制
+
     def __init__(self, **kwargs):
         ...
 
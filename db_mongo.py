@@ -1,7 +1,9 @@
-from pymongo import MongoClient, IndexModel, ASCENDING
+from pymongo import MongoClient, IndexModel, ASCENDING, UpdateOne, ReturnDocument
 from pymongo.database import Database
+from pymongo.errors import OperationFailure, BulkWriteError
 from pydantic import BaseModel
 import os, importlib
+from datetime import datetime
 from collections import defaultdict
 from inspect import isclass
 
@@ -9,58 +11,178 @@ from .db_adapter import DataBaseAdapter
 
 
 class MongoAdapter(DataBaseAdapter):
-    def __init__(self, url: str, **kwargs):
+    def __init__(self, url: str, version_field: str = None, **kwargs):
         client = MongoClient(url)
         self.db = client[url.split('/')[-1]]
+        self.version_field = version_field
 
 
     def get_client(self):
         return self.db
 
 
-    def get_data(self, table_name, query):
-        d = self.db[table_name].find_one(trim_dict_none(query))
+    def get_data(self, table_name, query, projection=None):
+        d = self.db[table_name].find_one(trim_dict_none(query), projection=projection)
         return d
 
 
-    def get_data_by_id(self, table_name, query):
-        d = self.get_data(table_name, {'id': query['id']})
+    def get_data_by_id(self, table_name, query, projection=None):
+        d = self.get_data(table_name, {'id': query['id']}, projection)
         return d
 
 
-    def get_datas(self, table_name, query):
-        l = self.db[table_name].find(trim_dict_none(query))
+    def get_datas(self, table_name, query, projection=None, sort=None, limit=None, after=None):
+        '''
+        projection: 返回的字段，如{'_id': False, 'id': True}
+        sort: [(field, 1/-1), ...]
+        after: 上一页最后一条数据的排序字段值，用于游标分页（keyset）
+        '''
+        query = trim_dict_none(query)
+        if after:
+            query = build_keyset_query(query, sort, after)
+        l = self.db[table_name].find(query, projection=projection, sort=sort, limit=limit or 0)
         return list(l)
     
 
+    def iter_datas(self, table_name, query, projection=None, sort=None, batch_size=1000):
+        '''
+        按批次迭代查询结果，每次返回一个列表，内存占用与结果总量无关
+        '''
+        l = self.db[table_name].find(trim_dict_none(query), projection=projection, sort=sort, batch_size=batch_size)
+        batch = []
+        for d in l:
+            batch.append(d)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
     def create_data(self, table_name, data):
         if isinstance(data, dict):
-            ret = self.db[table_name].insert_one(data)
+            ret = self.db[table_name].insert_one(set_version(data, self.version_field))
         elif isinstance(data, BaseModel):
-            ret = self.db[table_name].insert_one(data.dict())
+            ret = self.db[table_name].insert_one(set_version(data.dict(), self.version_field))
         else:
             raise
         return ret
 
 
+    def create_datas(self, table_name, datas, chunk_size=1000):
+        '''
+        按chunk_size分批执行无序insert_many，单条失败不影响其他数据
+        返回: {'inserted_count': 成功条数, 'errors': [{'index': 下标, 'code': 错误码, 'errmsg': 错误信息}, ...]}
+        '''
+        datas = [set_version(d.dict() if isinstance(d, BaseModel) else d, self.version_field) for d in datas]
+        result = {'inserted_count': 0, 'errors': []}
+        for offset in range(0, len(datas), chunk_size):
+            chunk = datas[offset: offset + chunk_size]
+            try:
+                ret = self.db[table_name].insert_many(chunk, ordered=False)
+                result['inserted_count'] += len(ret.inserted_ids)
+            except BulkWriteError as e:
+                merge_bulk_write_error(result, e, offset)
+        return result
+
+
     def update_data(self, table_name, query, new_data):
         ret = self.db[table_name].update_one(
             trim_dict_none(query), 
-            {'$set': trim_dict_none(new_data)},
+            build_update(new_data, self.version_field),
         )
         return ret
 
 
+    def find_and_update_data(self, table_name, query, new_data, projection=None, trim_none=True, return_before=False):
+        '''
+        修改并返回修改后的数据（一次往返），没有符合条件的数据时返回None
+        query中可以带版本号条件，实现乐观并发控制
+        trim_none为False时，new_data中的None也会写入（调用方需只传要修改的字段）
+        return_before为True时返回被这次修改替换的数据
+        '''
+        if not (trim_dict_none(new_data) if trim_none else new_data):  # 没有要修改的字段，只读取，不递增版本号
+            return self.db[table_name].find_one(trim_dict_none(query), projection)
+        d = self.db[table_name].find_one_and_update(
+            trim_dict_none(query),
+            build_update(new_data, self.version_field, trim_none=trim_none),
+            projection=projection,
+            return_document=ReturnDocument.BEFORE if return_before else ReturnDocument.AFTER,
+        )
+        return d
+
+
+    def find_and_delete_data(self, table_name, query, projection=None):
+        '''
+        删除并返回被删除的数据，没有符合条件的数据时返回None
+        '''
+        return self.db[table_name].find_one_and_delete(trim_dict_none(query), projection=projection)
+
+
     def update_data_by_id(self, table_name, query, new_data):
         if isinstance(new_data, dict):
             data = new_data
         elif isinstance(new_data, BaseModel):
-            data = new_data.dict()
+            data = new_data.dict(exclude_unset=True)
         else:
             raise
         return self.update_data(table_name, {'id': query['id']}, data)
 
 
+    def update_datas(self, table_name, query, new_data):
+        ret = self.db[table_name].update_many(
+            trim_dict_none(query),
+            build_update(new_data, self.version_field),
+        )
+        return ret
+
+
+    def bulk_update_data_by_id(self, table_name, datas, chunk_size=1000):
+        '''
+        datas: [(id, new_data), ...]，按chunk_size分批执行无序bulk_write
+        返回: {'matched_count': int, 'modified_count': int, 'errors': [...]}
+        '''
+        requests = [
+            UpdateOne({'id': id}, build_update(new_data, self.version_field))
+            for id, new_data in datas
+        ]
+        result = {'matched_count': 0, 'modified_count': 0, 'errors': []}
+        for offset in range(0, len(requests), chunk_size):
+            try:
+                ret = self.db[table_name].bulk_write(requests[offset: offset + chunk_size], ordered=False)
+                result['matched_count'] += ret.matched_count
+                result['modified_count'] += ret.modified_count
+            except BulkWriteError as e:
+                merge_bulk_write_error(result, e, offset)
+        return result
+
+
+    def count_datas(self, table_name, query, limit=None):
+        '''
+        统计符合条件的数据条数，没有条件时使用集合元数据中的估算值（不扫描），limit: 最多数到limit条
+        '''
+        query = trim_dict_none(query)
+        if not query and not limit:
+            return self.db[table_name].estimated_document_count()
+        kwargs = {'limit': limit} if limit else {}
+        return self.db[table_name].count_documents(query, **kwargs)
+
+
+    def aggregate_datas(self, table_name, pipeline, allow_disk_use=False):
+        '''
+        执行聚合管道，allow_disk_use: 超过内存限制的阶段是否允许写临时文件
+        '''
+        return list(self.db[table_name].aggregate(pipeline, allowDiskUse=allow_disk_use))
+
+
+    def exists_data(self, table_name, query):
+        '''
+        判断数据是否存在，只从索引中读取id，不读取整条数据
+        '''
+        d = self.db[table_name].find_one(trim_dict_none(query), projection={'_id': False, 'id': True})
+        return d is not None
+
+
     def delete_data(self, table_name, query):
         d = self.db[table_name].delete_one(trim_dict_none(query))
         return d
@@ -71,10 +193,110 @@ class MongoAdapter(DataBaseAdapter):
         return ret
 
 
-def get_and_inc_collection_counter_id(db: Database, collection_name='test') -> int:
+    def delete_datas(self, table_name, query):
+        ret = self.db[table_name].delete_many(trim_dict_none(query))
+        return ret
+
+
+    def bulk_delete_data_by_id(self, table_name, ids, chunk_size=1000):
+        '''
+        按chunk_size分批，每批用一次$in删除
+        返回: {'deleted_count': int}
+        '''
+        result = {'deleted_count': 0}
+        for offset in range(0, len(ids), chunk_size):
+            ret = self.db[table_name].delete_many({'id': {'$in': ids[offset: offset + chunk_size]}})
+            result['deleted_count'] += ret.deleted_count
+        return result
+
+
+    def inc_counter_id(self, collection_name, n=1):
+        return get_and_inc_collection_counter_id(self.db, collection_name, n)
+
+
+    def update_file_refs(self, deltas: dict):
+        '''
+        按对象名增减文件的引用计数（去重上传），deltas: {object_name: n}
+        '''
+        if deltas:
+            now = datetime.utcnow()
+            self.db['file_ref'].bulk_write([
+                UpdateOne({'object': object_name}, {'$inc': {'count': n}, '$set': {'updated_at': now}}, upsert=True)
+                for object_name, n in deltas.items()
+            ], ordered=False)
+
+
+    def reserve_file_ref(self, object_name):
+        '''
+        上传前占用对象的引用（计数+1），返回占用前的记录（不存在时为None）
+        '''
+        return self.db['file_ref'].find_one_and_update(
+            {'object': object_name},
+            {'$inc': {'count': 1}, '$set': {'updated_at': datetime.utcnow()}},
+            upsert=True,
+            projection={'_id': False},
+            return_document=ReturnDocument.BEFORE,
+        )
+
+
+    def claim_unreferenced_files(self, before) -> list:
+        '''
+        将在before之前引用计数已降为0的记录标记为删除中（deleting），返回对应的对象名
+        逐条按条件标记，期间被重新引用的记录不会被标记；删除中断遗留的标记在下次执行时重新认领
+        '''
+        query = {
+            'count': {'$lte': 0},
+            'updated_at': {'$lt': before},
+            '$or': [{'deleting': {'$exists': False}}, {'deleting': {'$lt': before}}],
+        }
+        object_names = []
+        for d in list(self.db['file_ref'].find(query, projection={'_id': True})):
+            d = self.db['file_ref'].find_one_and_update({'_id': d['_id'], **query}, {'$set': {'deleting': datetime.utcnow()}})
+            if d is not None:
+                object_names.append(d['object'])
+        return object_names
+
+
+    def finish_unreferenced_files(self, object_names: list):
+        '''
+        对象删除后移除删除中的记录；删除期间被占用的记录保留并清除标记
+        '''
+        if object_names:
+            query = {'object': {'$in': object_names}, 'deleting': {'$exists': True}}
+            self.db['file_ref'].delete_many({**query, 'count': {'$lte': 0}})
+            self.db['file_ref'].update_many(query, {'$unset': {'deleting': ''}})
+
+
+    def sync_indexes(self, table_name, indexes, dry_run=False):
+        '''
+        对比声明的索引与数据库中已有的索引，创建缺失的索引（dry_run时只对比）
+        indexes: [{'keys': [(field, 1/-1)], 'unique': bool, ...}, ...]
+        '''
+        collection = self.db[table_name]
+        report, missing = diff_indexes(collection.index_information(), build_index_models(indexes))
+        if not dry_run:
+            for index_model in missing:
+                name = index_model.document['name']
+                try:
+                    collection.create_indexes([index_model])
+                    report['created'].append(name)
+                except OperationFailure as e:
+                    report['failed'][name] = str(e)
+        return report
+
+
+    def get_index_specs(self, table_name) -> list:
+        '''
+        读取数据库中已有的索引，格式与索引声明相同: [{'keys': [(field, 1/-1)], 'unique': bool}, ...]
+        '''
+        index_information = self.db[table_name].index_information()
+        return [{'keys': list(info['key']), 'unique': bool(info.get('unique'))} for info in index_information.values()]
+
+
+def get_and_inc_collection_counter_id(db: Database, collection_name='test', n=1) -> int:
     result = db['counter_id'].find_one_and_update(
         {'collection': collection_name},    # 查询
-        {'$inc': {'id': 1}},                # 递增字段
+        {'$inc': {'id': n}},                # 递增字段
         upsert=True,                        # 如果不存在，将新建
         projection={'id': True, '_id': False},  # 返回的字段
         return_document=True,               # 返回递增前(False)，还是递增后(True)的结果
@@ -109,5 +331,94 @@ def get_collection_counter_id(db: Database, collection_name='test') -> int:
     return result.get('id')
 
 
+def merge_bulk_write_error(result: dict, e: BulkWriteError, offset: int = 0):
+    '''
+    将BulkWriteError中的成功条数和单条错误合并到结果中
+    '''
+    details = e.details
+    for key, n_key in (('inserted_count', 'nInserted'), ('matched_count', 'nMatched'), ('modified_count', 'nModified')):
+        if key in result:
+            result[key] += details.get(n_key, 0)
+    for err in details.get('writeErrors', []):
+        result['errors'].append({
+            'index': offset + err['index'],
+            'code': err.get('code'),
+            'errmsg': err.get('errmsg'),
+        })
+
+
+def build_index_models(indexes: list) -> list:
+    '''
+    将索引声明转换为IndexModel
+    '''
+    index_models = []
+    for index in indexes:
+        kwargs = {k: v for k, v in index.items() if k != 'keys' and v is not False}
+        index_models.append(IndexModel(index['keys'], **kwargs))
+    return index_models
+
+
+def diff_indexes(index_information: dict, index_models: list):
+    '''
+    对比已有索引和声明的索引，返回报告和缺失的IndexModel
+    '''
+    declared = {im.document['name']: im for im in index_models}
+    missing = [im for name, im in declared.items() if name not in index_information]
+    report = {
+        'missing': [im.document['name'] for im in missing],
+        'extra': sorted(name for name in index_information if name != '_id_' and name not in declared),
+        'mismatch': sorted(
+            name for name, im in declared.items()
+            if name in index_information and (
+                bool(index_information[name].get('unique')) != bool(im.document.get('unique'))
+                or ('weights' in im.document and index_information[name].get('weights') != im.document['weights'])
+            )
+        ),
+        'created': [],
+        'failed': {},
+    }
+    return report, missing
+
+
+def build_keyset_query(query: dict, sort: list, after: dict) -> dict:
+    '''
+    根据排序字段和上一页最后一条数据，构建游标分页的查询条件，可命中排序字段上的索引
+    null和缺失的值排在最前：$gt/$lt与None比较不会匹配任何数据，需单独处理
+    '''
+    ors = []
+    for i, (field, direction) in enumerate(sort):
+        prefix = {f: after[f] for f, _ in sort[:i]}   # {f: None}同时匹配null和缺失的字段
+        value = after[field]
+        if value is None:
+            if direction == ASCENDING:  # 升序时null之后是所有非null的值；降序时null之后没有数据
+                ors.append({**prefix, field: {'$ne': None}})
+        else:
+            ors.append({**prefix, field: {'$gt' if direction == ASCENDING else '$lt': value}})
+            if direction != ASCENDING:  # 降序时null排在所有值之后
+                ors.append({**prefix, field: None})
+    keyset = ors[0] if len(ors) == 1 else {'$or': ors}
+    return {'$and': [query, keyset]} if query else keyset
+
+
 def trim_dict_none(d: dict):
     return {k: v for k, v in d.items() if v is not None}
+
+
+def build_update(new_data: dict, version_field: str = None, trim_none: bool = True) -> dict:
+    '''
+    构建修改语句，设置了版本号字段时每次修改原子地递增版本号
+    trim_none为False时，new_data中的None也会写入
+    '''
+    update = {'$set': trim_dict_none(new_data) if trim_none else new_data}
+    if version_field:
+        update['$inc'] = {version_field: 1}
+    return update
+
+
+def set_version(data: dict, version_field: str = None) -> dict:
+    '''
+    新增数据的版本号从1开始
+    '''
+    if version_field:
+        data[version_field] = 1
+    return data
@@ -0,0 +1,250 @@
+from datetime import datetime
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure, BulkWriteError
+from pydantic import BaseModel
+
+from .db_adapter import DataBaseAdapter
+from .db_mongo import trim_dict_none, build_keyset_query, build_index_models, diff_indexes, merge_bulk_write_error, build_update, set_version
+
+
+class AsyncMongoAdapter(DataBaseAdapter):
+    '''
+    基于motor的异步mongo适配器，数据读写方法均为协程
+    '''
+    is_async = True
+
+    def __init__(self, url: str, version_field: str = None, **kwargs):
+        client = AsyncIOMotorClient(url)
+        self.db = client[url.split('/')[-1]]
+        self.version_field = version_field
+
+
+    def get_client(self):
+        return self.db
+
+
+    async def get_data(self, table_name, query, projection=None):
+        d = await self.db[table_name].find_one(trim_dict_none(query), projection=projection)
+        return d
+
+
+    async def get_data_by_id(self, table_name, query, projection=None):
+        d = await self.get_data(table_name, {'id': query['id']}, projection)
+        return d
+
+
+    async def get_datas(self, table_name, query, projection=None, sort=None, limit=None, after=None):
+        query = trim_dict_none(query)
+        if after:
+            query = build_keyset_query(query, sort, after)
+        l = self.db[table_name].find(query, projection=projection, sort=sort, limit=limit or 0)
+        return await l.to_list(length=None)
+
+
+    async def iter_datas(self, table_name, query, projection=None, sort=None, batch_size=1000):
+        l = self.db[table_name].find(trim_dict_none(query), projection=projection, sort=sort, batch_size=batch_size)
+        batch = []
+        async for d in l:
+            batch.append(d)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+    async def create_data(self, table_name, data):
+        if isinstance(data, dict):
+            ret = await self.db[table_name].insert_one(set_version(data, self.version_field))
+        elif isinstance(data, BaseModel):
+            ret = await self.db[table_name].insert_one(set_version(data.dict(), self.version_field))
+        else:
+            raise
+        return ret
+
+
+    async def create_datas(self, table_name, datas, chunk_size=1000):
+        datas = [set_version(d.dict() if isinstance(d, BaseModel) else d, self.version_field) for d in datas]
+        result = {'inserted_count': 0, 'errors': []}
+        for offset in range(0, len(datas), chunk_size):
+            chunk = datas[offset: offset + chunk_size]
+            try:
+                ret = await self.db[table_name].insert_many(chunk, ordered=False)
+                result['inserted_count'] += len(ret.inserted_ids)
+            except BulkWriteError as e:
+                merge_bulk_write_error(result, e, offset)
+        return result
+
+
+    async def update_data(self, table_name, query, new_data):
+        ret = await self.db[table_name].update_one(
+            trim_dict_none(query),
+            build_update(new_data, self.version_field),
+        )
+        return ret
+
+
+    async def find_and_update_data(self, table_name, query, new_data, projection=None, trim_none=True, return_before=False):
+        if not (trim_dict_none(new_data) if trim_none else new_data):  # 没有要修改的字段，只读取，不递增版本号
+            return await self.db[table_name].find_one(trim_dict_none(query), projection)
+        d = await self.db[table_name].find_one_and_update(
+            trim_dict_none(query),
+            build_update(new_data, self.version_field, trim_none=trim_none),
+            projection=projection,
+            return_document=ReturnDocument.BEFORE if return_before else ReturnDocument.AFTER,
+        )
+        return d
+
+
+    async def find_and_delete_data(self, table_name, query, projection=None):
+        return await self.db[table_name].find_one_and_delete(trim_dict_none(query), projection=projection)
+
+
+    async def update_data_by_id(self, table_name, query, new_data):
+        if isinstance(new_data, dict):
+            data = new_data
+        elif isinstance(new_data, BaseModel):
+            data = new_data.dict(exclude_unset=True)
+        else:
+            raise
+        return await self.update_data(table_name, {'id': query['id']}, data)
+
+
+    async def update_datas(self, table_name, query, new_data):
+        ret = await self.db[table_name].update_many(
+            trim_dict_none(query),
+            build_update(new_data, self.version_field),
+        )
+        return ret
+
+
+    async def bulk_update_data_by_id(self, table_name, datas, chunk_size=1000):
+        requests = [
+            UpdateOne({'id': id}, build_update(new_data, self.version_field))
+            for id, new_data in datas
+        ]
+        result = {'matched_count': 0, 'modified_count': 0, 'errors': []}
+        for offset in range(0, len(requests), chunk_size):
+            try:
+                ret = await self.db[table_name].bulk_write(requests[offset: offset + chunk_size], ordered=False)
+                result['matched_count'] += ret.matched_count
+                result['modified_count'] += ret.modified_count
+            except BulkWriteError as e:
+                merge_bulk_write_error(result, e, offset)
+        return result
+
+
+    async def count_datas(self, table_name, query, limit=None):
+        query = trim_dict_none(query)
+        if not query and not limit:
+            return await self.db[table_name].estimated_document_count()
+        kwargs = {'limit': limit} if limit else {}
+        return await self.db[table_name].count_documents(query, **kwargs)
+
+
+    async def aggregate_datas(self, table_name, pipeline, allow_disk_use=False):
+        cursor = self.db[table_name].aggregate(pipeline, allowDiskUse=allow_disk_use)
+        return await cursor.to_list(None)
+
+
+    async def exists_data(self, table_name, query):
+        d = await self.db[table_name].find_one(trim_dict_none(query), projection={'_id': False, 'id': True})
+        return d is not None
+
+
+    async def delete_data(self, table_name, query):
+        d = await self.db[table_name].delete_one(trim_dict_none(query))
+        return d
+
+
+    async def delete_data_by_id(self, table_name, query):
+        ret = await self.delete_data(table_name, {'id': query['id']})
+        return ret
+
+
+    async def delete_datas(self, table_name, query):
+        ret = await self.db[table_name].delete_many(trim_dict_none(query))
+        return ret
+
+
+    async def bulk_delete_data_by_id(self, table_name, ids, chunk_size=1000):
+        result = {'deleted_count': 0}
+        for offset in range(0, len(ids), chunk_size):
+            ret = await self.db[table_name].delete_many({'id': {'$in': ids[offset: offset + chunk_size]}})
+            result['deleted_count'] += ret.deleted_count
+        return result
+
+
+    async def inc_counter_id(self, collection_name, n=1):
+        return await get_and_inc_collection_counter_id(self.db, collection_name, n)
+
+
+    async def update_file_refs(self, deltas: dict):
+        if deltas:
+            now = datetime.utcnow()
+            await self.db['file_ref'].bulk_write([
+                UpdateOne({'object': object_name}, {'$inc': {'count': n}, '$set': {'updated_at': now}}, upsert=True)
+                for object_name, n in deltas.items()
+            ], ordered=False)
+
+
+    async def reserve_file_ref(self, object_name):
+        return await self.db['file_ref'].find_one_and_update(
+            {'object': object_name},
+            {'$inc': {'count': 1}, '$set': {'updated_at': datetime.utcnow()}},
+            upsert=True,
+            projection={'_id': False},
+            return_document=ReturnDocument.BEFORE,
+        )
+
+
+    async def claim_unreferenced_files(self, before) -> list:
+        query = {
+            'count': {'$lte': 0},
+            'updated_at': {'$lt': before},
+            '$or': [{'deleting': {'$exists': False}}, {'deleting': {'$lt': before}}],
+        }
+        object_names = []
+        for d in await self.db['file_ref'].find(query, projection={'_id': True}).to_list(length=None):
+            d = await self.db['file_ref'].find_one_and_update({'_id': d['_id'], **query}, {'$set': {'deleting': datetime.utcnow()}})
+            if d is not None:
+                object_names.append(d['object'])
+        return object_names
+
+
+    async def finish_unreferenced_files(self, object_names: list):
+        if object_names:
+            query = {'object': {'$in': object_names}, 'deleting': {'$exists': True}}
+            await self.db['file_ref'].delete_many({**query, 'count': {'$lte': 0}})
+            await self.db['file_ref'].update_many(query, {'$unset': {'deleting': ''}})
+
+
+    async def sync_indexes(self, table_name, indexes, dry_run=False):
+        collection = self.db[table_name]
+        report, missing = diff_indexes(await collection.index_information(), build_index_models(indexes))
+        if not dry_run:
+            for index_model in missing:
+                name = index_model.document['name']
+                try:
+                    await collection.create_indexes([index_model])
+                    report['created'].append(name)
+                except OperationFailure as e:
+                    report['failed'][name] = str(e)
+        return report
+
+
+    async def get_index_specs(self, table_name) -> list:
+        index_information = await self.db[table_name].index_information()
+        return [{'keys': list(info['key']), 'unique': bool(info.get('unique'))} for info in index_information.values()]
+
+
+async def get_and_inc_collection_counter_id(db: AsyncIOMotorDatabase, collection_name='test', n=1) -> int:
+    result = await db['counter_id'].find_one_and_update(
+        {'collection': collection_name},
+        {'$inc': {'id': n}},
+        upsert=True,
+        projection={'id': True, '_id': False},
+        return_document=ReturnDocument.AFTER,
+    )
+    return result.get('id')
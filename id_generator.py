@@ -0,0 +1,157 @@
+import os
+import time
+import asyncio
+import threading
+
+from .concurrency import call_adapter
+
+
+class IdGenerator:
+    '''
+    id生成器基类
+    get_ids: 同步调用（同步数据库适配器）
+    async_get_ids: 在接口中调用，同步适配器的数据库操作放入线程池执行
+    '''
+    def __init__(self, db_adapter=None, **kwargs):
+        self.db_adapter = db_adapter
+
+    def get_ids(self, collection_name, n=1) -> list:
+        ...
+
+    async def async_get_ids(self, collection_name, n=1) -> list:
+        ...
+
+    def get_id(self, collection_name) -> int:
+        return self.get_ids(collection_name, 1)[0]
+
+    async def async_get_id(self, collection_name) -> int:
+        return (await self.async_get_ids(collection_name, 1))[0]
+
+
+class CounterIdGenerator(IdGenerator):
+    '''
+    每次取id都递增数据库中的counter_id（默认行为）
+    '''
+    def get_ids(self, collection_name, n=1) -> list:
+        last_id = self.db_adapter.inc_counter_id(collection_name, n)
+        return list(range(last_id - n + 1, last_id + 1))
+
+    async def async_get_ids(self, collection_name, n=1) -> list:
+        last_id = await call_adapter(self.db_adapter, 'inc_counter_id', collection_name, n)
+        return list(range(last_id - n + 1, last_id + 1))
+
+
+class BlockIdGenerator(IdGenerator):
+    '''
+    每个进程用一次$inc租用block_size个id，之后从内存中分配
+    进程重启时未用完的id会被丢弃，id仍然唯一递增，但不连续
+    '''
+    def __init__(self, db_adapter=None, block_size=100, **kwargs):
+        super().__init__(db_adapter)
+        self.block_size = block_size
+        self.blocks = {}            # collection_name -> [下一个id, 结束id(不含)]
+        self.lock = threading.Lock()    # 保护blocks，持有期间不做IO
+        self.refill_locks = {}
+        self.async_refill_locks = {}
+
+    def _take(self, collection_name, n) -> list:
+        with self.lock:
+            block = self.blocks.get(collection_name)
+            if not block:
+                return []
+            start = block[0]
+            end = min(block[1], start + n)
+            block[0] = end
+            return list(range(start, end))
+
+    def _put_block(self, collection_name, last_id, size):
+        with self.lock:
+            self.blocks[collection_name] = [last_id - size + 1, last_id + 1]
+
+    def _get_refill_lock(self, locks, collection_name, lock_class):
+        with self.lock:
+            if collection_name not in locks:
+                locks[collection_name] = lock_class()
+            return locks[collection_name]
+
+    def get_ids(self, collection_name, n=1) -> list:
+        ids = self._take(collection_name, n)
+        while len(ids) < n:
+            with self._get_refill_lock(self.refill_locks, collection_name, threading.Lock):
+                ids += self._take(collection_name, n - len(ids))    # 等锁期间可能已被其他线程补充
+                if len(ids) < n:
+                    size = max(self.block_size, n - len(ids))
+                    self._put_block(collection_name, self.db_adapter.inc_counter_id(collection_name, size), size)
+        return ids
+
+    async def async_get_ids(self, collection_name, n=1) -> list:
+        ids = self._take(collection_name, n)
+        while len(ids) < n:
+            async with self._get_refill_lock(self.async_refill_locks, collection_name, asyncio.Lock):
+                ids += self._take(collection_name, n - len(ids))
+                if len(ids) < n:
+                    size = max(self.block_size, n - len(ids))
+                    last_id = await call_adapter(self.db_adapter, 'inc_counter_id', collection_name, size)
+                    self._put_block(collection_name, last_id, size)
+        return ids
+
+
+class SnowflakeIdGenerator(IdGenerator):
+    '''
+    不依赖数据库的64位id：41位毫秒时间戳 + 10位worker_id + 12位序列号
+    worker_id默认取环境变量MAPLE_API_WORKER_ID，否则取进程号，多进程/多机部署时需保证唯一
+    '''
+    worker_id_bits = 10
+    sequence_bits = 12
+
+    def __init__(self, db_adapter=None, worker_id=None, epoch=1577836800000, **kwargs):
+        super().__init__(db_adapter)
+        if worker_id is None:
+            worker_id = int(os.environ.get('MAPLE_API_WORKER_ID', os.getpid()))
+        self.worker_id = worker_id & ((1 << self.worker_id_bits) - 1)
+        self.epoch = epoch
+        self.last_timestamp = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def _next_id(self) -> int:
+        # 时钟回拨时沿用上次的时间戳，序列号用完时借用下一毫秒，保证单调递增
+        timestamp = max(int(time.time() * 1000), self.last_timestamp)
+        if timestamp == self.last_timestamp:
+            self.sequence = (self.sequence + 1) & ((1 << self.sequence_bits) - 1)
+            if self.sequence == 0:
+                timestamp += 1
+        else:
+            self.sequence = 0
+        self.last_timestamp = timestamp
+        return ((timestamp - self.epoch) << (self.worker_id_bits + self.sequence_bits)) \
+            | (self.worker_id << self.sequence_bits) \
+            | self.sequence
+
+    def get_ids(self, collection_name, n=1) -> list:
+        with self.lock:
+            return [self._next_id() for _ in range(n)]
+
+    async def async_get_ids(self, collection_name, n=1) -> list:
+        return self.get_ids(collection_name, n)
+
+
+def build_id_generator(db_adapter, id_generator_conf=None) -> IdGenerator:
+    '''
+    id_generator_conf: {
+        'name': 'counter',  # counter: 每次递增counter_id; block: 批量租用id; snowflake: 雪花id
+        'block_size': 100,  # block可选
+        'worker_id': 1,     # snowflake可选
+    }
+    '''
+    if isinstance(id_generator_conf, IdGenerator):
+        return id_generator_conf
+    id_generator_conf = dict(id_generator_conf or {'name': 'counter'})
+    name = id_generator_conf.pop('name', 'counter')
+    if name == 'counter':
+        return CounterIdGenerator(db_adapter, **id_generator_conf)
+    elif name == 'block':
+        return BlockIdGenerator(db_adapter, **id_generator_conf)
+    elif name == 'snowflake':
+        return SnowflakeIdGenerator(db_adapter, **id_generator_conf)
+    raise ValueError(f'未知的id生成器: {name}')
@@ -10,12 +10,16 @@ class MapleApi:
         *,
         storage_conf: dict = None,
         database_id_auto_incr = True,
+        id_generator_conf: dict = None,
     ):
         '''
         database_conf: {
-            'name': 'mongo',
+            'name': 'mongo',    # mongo: pymongo同步适配器; motor: 异步适配器
             'url': '',
         }
+        id_generator_conf: {
+            'name': 'counter',  # counter(默认): 每次插入递增counter_id; block: 批量租用id; snowflake: 雪花id
+        }
         '''
         self.backend = backend
         self.api_dict = {}
@@ -24,8 +28,15 @@ class MapleApi:
         if database_conf['name'] == 'mongo':
             from .db_mongo import MongoAdapter
             self.db_adapter = MongoAdapter(**database_conf)
+        elif database_conf['name'] == 'motor':
+            from .db_motor import AsyncMongoAdapter
+            self.db_adapter = AsyncMongoAdapter(**database_conf)
+
+        if hasattr(self, 'db_adapter'):
+            from .id_generator import build_id_generator
+            self.id_generator = build_id_generator(self.db_adapter, id_generator_conf)
 
-        if storage_conf['name'] == 'minio':
+        if storage_conf and storage_conf['name'] == 'minio':
             from .storage_minio import MinioAdapter
             self.sto_adapter = MinioAdapter(**storage_conf)
 
@@ -87,6 +98,8 @@ class MapleApi:
         model_file_paths: List[str],
         set_unique: bool = True,
         set_foreign_key: bool = True,
+        sync_index: bool = True,
+        index_dry_run: bool = False,
     ):
         assert True, '应该被重写'
 
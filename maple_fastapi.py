@@ -1,12 +1,24 @@
-from fastapi import FastAPI, APIRouter, Request, Path, File, UploadFile
+from fastapi import FastAPI, APIRouter, Request, Response, Path, Query, File, UploadFile, HTTPException
+from fastapi.responses import StreamingResponse
 from typing import List, Any, Dict, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from pydantic.fields import Undefined
 from fastapi.params import ParamTypes, Param
 from functools import wraps
+from collections import defaultdict
+from datetime import datetime, timedelta
+import inspect
+import os
+import json
+import hashlib
 
 from .maple_api import MapleApi
 from . import utils
+from .concurrency import run_sync, call_adapter, iterate_adapter, set_threadpool_size, SingleFlight
+from .cache import build_cache
+from .serializer import XJSONResponse, FieldSelector
+from .batcher import WriteBatcher
+from .storage_adapter import ObjectTooLargeError
 
 
 class MFastAPI(MapleApi):
@@ -17,8 +29,39 @@ class MFastAPI(MapleApi):
         *,
         storage_conf: dict = None,
         database_id_auto_incr = True,
-        prefix: str = ''
+        id_generator_conf: dict = None,
+        prefix: str = '',
+        threadpool_size: int = None,
+        page_size: int = 100,
+        max_page_size: int = 1000,
+        export_batch_size: int = 1000,
+        bulk_chunk_size: int = 1000,
+        bulk_max_items: int = 10000,
+        allow_bulk_filter_write: bool = False,
+        cache_conf: dict = None,
+        fast_response: bool = False,
+        write_batch_conf: dict = None,
+        single_flight: bool = False,
+        stats_max_groups: int = 1000,
+        stats_allow_disk_use: bool = False,
     ):
+        '''
+        threadpool_size: 同步适配器调用所用线程池的大小，默认40
+        page_size: 列表接口未传limit时的默认分页大小，None表示不分页
+        max_page_size: 列表接口limit的上限，None表示不限制
+        export_batch_size: 导出接口每批从数据库读取的条数
+        bulk_chunk_size: 批量接口每次insert_many的条数
+        bulk_max_items: 批量接口单次请求的最大条数
+        allow_bulk_filter_write: 是否允许批量修改/删除接口按条件(update_many/delete_many)操作
+        cache_conf: 按id查询接口的缓存配置，模型的X_Config.cache为True或dict时开启，dict会覆盖此配置
+            {'name': 'lru', 'maxsize': 1024, 'ttl': 60}
+        fast_response: 读接口直接从数据库文档中选取_Out字段并序列化，不再经过response_model校验
+        write_batch_conf: 合并并发的单条新增为一次insert_many，None表示不开启
+            {'max_delay': 0.002, 'max_size': 100}
+        single_flight: 按id查询和列表接口中，相同的并发查询只发送一次，其余请求等待同一结果
+        stats_max_groups: 统计接口返回的最大分组数，超过时返回400
+        stats_allow_disk_use: 统计接口的聚合管道是否允许使用磁盘（allowDiskUse）
+        '''
         if backend is None:
             backend = FastAPI()
 
@@ -27,8 +70,30 @@ class MFastAPI(MapleApi):
             database_conf,
             storage_conf = storage_conf,
             database_id_auto_incr = database_id_auto_incr,
+            id_generator_conf = id_generator_conf,
         )
         self.prefix = prefix
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.export_batch_size = export_batch_size
+        self.bulk_chunk_size = bulk_chunk_size
+        self.bulk_max_items = bulk_max_items
+        self.allow_bulk_filter_write = allow_bulk_filter_write
+        self.cache_conf = cache_conf or {'name': 'lru'}
+        self.cache_dict = {}
+        self.table_dict = {}
+        self.fast_response = fast_response
+        self.write_batch_conf = write_batch_conf
+        self.batcher_dict = {}
+        self.single_flight = single_flight
+        self.flight_dict = {}
+        self.stats_max_groups = stats_max_groups
+        self.stats_allow_disk_use = stats_allow_disk_use
+        self.index_dict = {}
+        self.index_report = {}
+        self.existing_index_dict = {}   # 启动时读取的数据库中已有的索引，用于校验排序
+        if threadpool_size:
+            set_threadpool_size(threadpool_size)
         print('backend: fastapi')
 
 
@@ -42,10 +107,126 @@ class MFastAPI(MapleApi):
         model_file_paths: List[str],
         set_unique: bool = True,
         set_foreign_key: bool = True,
+        sync_index: bool = True,
+        index_dry_run: bool = False,
     ):
+        '''
+        sync_index: 服务启动时根据模型声明创建索引
+        index_dry_run: 只对比并报告缺失/多余的索引，不创建（用于生产环境）
+        '''
         models = utils.get_models_from_paths(model_file_paths)
         # print(models)
         self.gen_simple_api(models)
+        if sync_index and hasattr(self, 'db_adapter'):
+            self.gen_index(models, set_unique, set_foreign_key, dry_run=index_dry_run)
+        elif hasattr(self, 'db_adapter'):
+            table_names = [utils.get_model_meta(m).table_name for m in models]
+            async def load_indexes():
+                await self.load_existing_indexes(table_names)
+            self.backend.add_event_handler('startup', load_indexes)
+
+
+    def gen_index(
+        self,
+        models,
+        set_unique: bool = True,
+        set_foreign_key: bool = True,
+        *,
+        dry_run: bool = False,
+    ):
+        '''
+        根据模型声明索引，在服务启动时与数据库中的索引对比并创建，结果记录在index_report中
+        '''
+        for m in models:
+            table_name = utils.get_model_meta(m).table_name
+            self.index_dict[table_name] = utils.get_index_specs_from_pydantic_model(m, set_unique, set_foreign_key)
+        if hasattr(self.db_adapter, 'inc_counter_id'):
+            self.index_dict['counter_id'] = [{'keys': [('collection', 1)], 'unique': True}]
+        if hasattr(self, 'sto_adapter') and self.sto_adapter.dedup:
+            self.index_dict['file_ref'] = [
+                {'keys': [('object', 1)], 'unique': True},
+                {'keys': [('count', 1), ('updated_at', 1)]},
+            ]
+
+        async def sync_indexes():
+            for table_name, indexes in self.index_dict.items():
+                report = await self.db_call('sync_indexes', table_name, indexes, dry_run=dry_run)
+                self.index_report[table_name] = report
+                if any(report.values()):
+                    print(f'索引[{table_name}]: {report}')
+            # dry_run或创建失败时声明的索引并不存在，排序按同步后实际存在的索引校验
+            await self.load_existing_indexes(self.index_dict)
+        self.backend.add_event_handler('startup', sync_indexes)
+
+
+    async def load_existing_indexes(self, table_names):
+        '''
+        读取数据库中已有的索引，列表接口只接受这些索引能提供的排序
+        '''
+        for table_name in table_names:
+            self.existing_index_dict[table_name] = await self.db_call('get_index_specs', table_name)
+
+
+    async def db_call(self, method_name: str, *args, **kwargs):
+        '''
+        调用数据库适配器，同步适配器在线程池中执行，不阻塞事件循环
+        '''
+        return await call_adapter(self.db_adapter, method_name, *args, **kwargs)
+
+
+    async def read_call(self, method_name: str, table_name: str, *args, **kwargs):
+        '''
+        只读的数据库调用，开启single_flight时按(方法, 表, 查询, 投影等参数)合并相同的并发查询
+        '''
+        if not self.single_flight:
+            return await self.db_call(method_name, table_name, *args, **kwargs)
+        flight = self.flight_dict.get(table_name)
+        if flight is None:
+            flight = self.flight_dict[table_name] = SingleFlight()
+        key = json.dumps([method_name, args, kwargs], sort_keys=True, default=lambda o: [type(o).__name__, str(o)])
+        return await flight.do(key, self.db_call, method_name, table_name, *args, **kwargs)
+
+
+    def get_single_flight_stats(self) -> dict:
+        '''
+        各表实际执行的查询数和被合并的请求数
+        '''
+        return {table_name: flight.get_stats() for table_name, flight in self.flight_dict.items()}
+
+
+    async def sto_call(self, method_name: str, *args, **kwargs):
+        '''
+        调用存储适配器
+        '''
+        return await call_adapter(self.sto_adapter, method_name, *args, **kwargs)
+
+
+    async def cache_call(self, table_name: str, method_name: str, *args):
+        '''
+        访问表的缓存，未开启缓存时返回None
+        '''
+        cache = self.cache_dict.get(table_name)
+        if cache is None:
+            return None
+        if cache.is_blocking:
+            return await run_sync(getattr(cache, method_name), *args)
+        return getattr(cache, method_name)(*args)
+
+
+    def get_cache_stats(self) -> dict:
+        '''
+        各表缓存的命中/未命中/淘汰次数
+        '''
+        return {table_name: cache.get_stats() for table_name, cache in self.cache_dict.items()}
+
+
+    def get_page_limit(self, limit: int = None):
+        '''
+        计算实际分页大小，服务端强制默认值和上限
+        '''
+        if limit is None:
+            return self.page_size
+        return min(limit, self.max_page_size) if self.max_page_size else limit
 
 
     def gen_simple_api(
@@ -54,17 +235,30 @@ class MFastAPI(MapleApi):
     ):
         for m in models:
             # prepare
-            table_name = utils.conv_under_line(m.__name__.split('.')[-1])
-            router = APIRouter(tags=[table_name])
+            meta = utils.get_model_meta(m)
+            table_name = meta.table_name
+            router = APIRouter(tags=[table_name], dependency_overrides_provider=self.backend)
 
             # build model
-            model_in = utils.build_new_model_from_pydantic_model_by_flag(m, flag='x_in', suffix='_In')
-            if utils.has_flag_from_pydantic_model(m, flag='x_exclude_out'):
-                model_out = utils.build_new_model_from_pydantic_model_by_flag(m, flag='x_exclude_out', reverse=True, suffix='_Out')
-            else:
-                model_out = utils.build_new_model_from_pydantic_model_by_flag(m, flag='x_out', suffix='_Out')
-            model_query = utils.build_new_model_from_pydantic_model_by_flag(m, flag='x_query', suffix='_Query', is_optional=True)
-            model_put = utils.build_new_model_from_pydantic_model_by_flag(m, flag='x_update', suffix='_Put', is_optional=True)
+            model_in = meta.model_in
+            model_out = meta.model_out
+            model_query = meta.model_query
+            model_put = meta.model_put
+            projection = meta.projection
+            self.table_dict[table_name] = {
+                'model': m,
+                'model_out': model_out,
+                'projection': projection,
+                'foreign_keys': meta.foreign_keys,
+                'selector': FieldSelector(model_out),
+                'file_fields': [f for f in meta.get_fields_name_by_flag('x_file') if f in model_out.__fields__],
+                'query_ops': meta.query_ops,
+            }
+
+            table_cache_conf = utils.get_x_config_from_pydantic_model(m, attr='cache')
+            if table_cache_conf:
+                cache_conf = {**self.cache_conf, **(table_cache_conf if isinstance(table_cache_conf, dict) else {})}
+                self.cache_dict[table_name] = build_cache(cache_conf, prefix=f'{table_name}:')
 
             # gen api
             if hasattr(self, 'db_adapter'):    # 存在数据库适配器
@@ -76,6 +270,7 @@ class MFastAPI(MapleApi):
                         'path': path,
                         'response_model': model_out,
                     },
+                    projection = projection,
                 )
 
                 path = self.prefix + '/' + table_name + 's'
@@ -87,6 +282,65 @@ class MFastAPI(MapleApi):
                         'path': path,
                         'response_model': List[model_out],
                     },
+                    projection = projection,
+                )
+
+                path = self.prefix + '/' + table_name + 's' + '/count'
+                self.gen_count_api(
+                    router,
+                    table_name,
+                    model_query,
+                    router_kwargs = {
+                        'path': path,
+                    },
+                )
+
+                group_fields, metric_ops = meta.stats_fields
+                if group_fields or metric_ops:
+                    path = self.prefix + '/' + table_name + 's' + '/stats'
+                    self.gen_stats_api(
+                        router,
+                        table_name,
+                        model_query,
+                        group_fields,
+                        metric_ops,
+                        router_kwargs = {
+                            'path': path,
+                        },
+                    )
+
+                if meta.search_fields:
+                    path = self.prefix + '/' + table_name + 's' + '/search'
+                    self.gen_search_api(
+                        router,
+                        table_name,
+                        model_query,
+                        router_kwargs = {
+                            'path': path,
+                            'response_model': List[model_out],
+                        },
+                        projection = projection,
+                    )
+
+                path = self.prefix + '/' + table_name + '/{id}'
+                self.gen_head_api(
+                    router,
+                    table_name,
+                    router_kwargs = {
+                        'path': path,
+                    },
+                )
+
+                path = self.prefix + '/' + table_name + 's' + '/export'
+                self.gen_export_api(
+                    router,
+                    table_name,
+                    model_query,
+                    model_out,
+                    router_kwargs = {
+                        'path': path,
+                    },
+                    projection = projection,
                 )
 
                 path = self.prefix + '/' + table_name
@@ -101,6 +355,39 @@ class MFastAPI(MapleApi):
                     },
                 )
 
+                path = self.prefix + '/' + table_name + '/bulk'
+                self.gen_bulk_post_api(
+                    router,
+                    table_name,
+                    model_in,
+                    m,
+                    router_kwargs = {
+                        'path': path,
+                    },
+                )
+
+                # 需在/{id}路由之前注册
+                path = self.prefix + '/' + table_name + '/bulk'
+                self.gen_bulk_put_api(
+                    router,
+                    table_name,
+                    model_put,
+                    model_query,
+                    router_kwargs = {
+                        'path': path,
+                    },
+                )
+
+                path = self.prefix + '/' + table_name + '/bulk'
+                self.gen_bulk_delete_api(
+                    router,
+                    table_name,
+                    model_query,
+                    router_kwargs = {
+                        'path': path,
+                    },
+                )
+
                 path = self.prefix + '/' + table_name + '/{id}'
                 self.gen_delete_api(
                     router,
@@ -117,12 +404,13 @@ class MFastAPI(MapleApi):
                     model_put,
                     router_kwargs = {
                         'path': path,
+                        'response_model': model_out,
                     },
+                    projection = projection,
                 )
 
             if hasattr(self, 'sto_adapter'):    # 存在存储适配器
-                model_file = utils.build_new_model_from_pydantic_model_by_flag(m, flag='x_file', suffix='_File', is_optional=True)
-                fields_name = utils.get_fields_name_from_pydantic_model(model_file)
+                fields_name = meta.get_fields_name_by_flag(flag='x_file')
                 for field_name in fields_name:
                     path = self.prefix + '/' + table_name + '/{id}' + '/file' + '/' + field_name
                     self.gen_upload_api(
@@ -133,9 +421,18 @@ class MFastAPI(MapleApi):
                             'path': path,
                         },
                     )
+                    self.gen_download_api(
+                        router,
+                        table_name,
+                        field_name,
+                        router_kwargs = {
+                            'path': path,
+                        },
+                    )
 
             # finish
-            self.backend.include_router(router)
+            # 路由已在router中构建完成，直接挂到app上，include_router会重新构建每个路由（克隆response_model）
+            self.backend.router.routes.extend(router.routes)
 
 
     def gen_complex_api_for_mongo(
@@ -143,30 +440,203 @@ class MFastAPI(MapleApi):
         models,
     ):
         for m in models:
-            field_dict = utils.get_fields_dict_from_pydantic_model_by_flag(m, flag='x_foreign_key')
+            field_dict = utils.get_fields_flag_info_from_pydantic_model_by_flag(m, flag='x_foreign_key')
             print(field_dict)
 
 
+    async def expand_datas(self, table_name: str, datas: list, expand: str) -> list:
+        '''
+        展开外键字段：每个外键字段只用一次$in查询关联表，返回只含_Out字段的新数据
+        expand: 逗号分隔的外键字段名，如'course_ids,user_id'
+        '''
+        table = self.table_dict[table_name]
+        out_fields = set(table['model_out'].__fields__)
+        fields = [f for f in expand.split(',') if f]
+        allowed = [f for f in table['foreign_keys'] if f in out_fields]
+        invalid = [f for f in fields if f not in allowed]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f'不能展开的字段: {invalid}，可展开: {allowed}')
+
+        datas = [{k: v for k, v in d.items() if k in out_fields} for d in datas]
+        for field in fields:
+            foreign_table, key, kind = table['foreign_keys'][field]
+            values = set()
+            for d in datas:
+                v = d.get(field)
+                if isinstance(v, list):
+                    values.update(v)
+                elif v is not None:
+                    values.add(v)
+            if not values:
+                continue
+
+            foreign_projection = self.table_dict.get(foreign_table, {}).get('projection')
+            if foreign_projection is not None:
+                foreign_projection = {**foreign_projection, key: True}
+            rows = await self.db_call('get_datas', foreign_table, {key: {'$in': list(values)}}, projection=foreign_projection)
+            rows = {r[key]: r for r in rows}
+            for d in datas:
+                v = d.get(field)
+                if isinstance(v, list):
+                    d[field] = [rows.get(x) for x in v]
+                elif v is not None:
+                    d[field] = rows.get(v)
+        return datas
+
+
+    async def resolve_file_urls(self, table_name: str, datas: list) -> list:
+        '''
+        存储为presigned模式时，x_file字段中保存的是对象名，读取时批量换成预签名地址
+        切换到presigned之前以stored模式保存的完整地址先解析出对象名再签名
+        返回新的数据，不修改缓存中的数据
+        '''
+        fields = self.table_dict[table_name]['file_fields']
+        if not fields or not hasattr(self, 'sto_adapter') or self.sto_adapter.url_mode != 'presigned':
+            return datas
+        datas = [dict(d) for d in datas]
+        items = [(d, f) for d in datas for f in fields if d.get(f)]
+        if items:
+            object_names = [self.sto_adapter.get_object_name(d[f]) for d, f in items]
+            urls = await self.sto_call('get_object_urls', object_names, use_presigned=True)
+            for (d, f), url in zip(items, urls):
+                d[f] = url
+        return datas
+
+
+    def get_etag_suffix(self, table_name: str) -> str:
+        '''
+        presigned模式下响应中的文件地址随签名窗口变化，将窗口计入ETag，窗口切换后不再返回304
+        '''
+        if not self.table_dict[table_name]['file_fields'] or not hasattr(self, 'sto_adapter') or self.sto_adapter.url_mode != 'presigned':
+            return ''
+        return f'-{self.sto_adapter.get_presigned_window()}'
+
+
+    def get_dedup_file_fields(self, table_name: str) -> list:
+        '''
+        开启去重上传时，返回表中需要维护引用计数的x_file字段
+        '''
+        if not hasattr(self, 'sto_adapter') or not self.sto_adapter.dedup:
+            return []
+        return utils.get_model_meta(self.table_dict[table_name]['model']).get_fields_name_by_flag('x_file')
+
+
+    async def delete_with_file_refs(self, table_name: str, query: dict) -> Optional[int]:
+        '''
+        开启去重上传时逐条find_one_and_delete，只释放实际被删除的数据所引用的对象，返回删除的条数
+        未开启去重上传时返回None，由调用方直接删除
+        '''
+        fields = self.get_dedup_file_fields(table_name)
+        if not fields:
+            return None
+        ids = [d['id'] for d in await self.db_call('get_datas', table_name, query, projection={'_id': False, 'id': True})]
+        deleted_count, removed = 0, []
+        for id in ids:
+            d = await self.db_call('find_and_delete_data', table_name, {**query, 'id': id}, projection={f: True for f in fields})
+            if d is not None:
+                deleted_count += 1
+                removed += [self.sto_adapter.get_object_name(d[f]) for f in fields if d.get(f)]
+        await self.update_file_refs(removed=removed)
+        return deleted_count
+
+
+    async def reserve_file_ref(self, object_name: str):
+        '''
+        上传前先占用对象的引用，占用后gc_files不会再删除该对象，之后判断对象是否存在才是可靠的
+        对象正在被gc_files删除时撤销占用并返回503
+        '''
+        old = await self.db_call('reserve_file_ref', object_name)
+        if old is not None and old.get('deleting'):
+            await self.update_file_refs(removed=[object_name])
+            raise HTTPException(status_code=503, detail='文件正在被清理，请稍后重试', headers={'Retry-After': '1'})
+
+
+    async def update_file_refs(self, added: list = (), removed: list = ()):
+        '''
+        增减对象的引用计数，计数降为0的对象由gc_files删除
+        '''
+        deltas = defaultdict(int)
+        for object_name in added:
+            deltas[object_name] += 1
+        for object_name in removed:
+            deltas[object_name] -= 1
+        deltas = {k: v for k, v in deltas.items() if v}
+        if deltas:
+            await self.db_call('update_file_refs', deltas)
+
+
+    async def gc_files(self, grace_period: int = 3600) -> list:
+        '''
+        删除引用计数为0超过grace_period秒的对象，返回被删除的对象名
+        先将引用记录标记为删除中，再删除对象，最后移除记录；上传在判断对象是否存在之前先占用引用，
+        遇到删除中的记录时不会跳过上传，因此不会引用到已删除的对象
+        '''
+        before = datetime.utcnow() - timedelta(seconds=grace_period)
+        object_names = await self.db_call('claim_unreferenced_files', before)
+        for object_name in object_names:
+            await self.sto_call('remove_object', object_name)
+        await self.db_call('finish_unreferenced_files', object_names)
+        return object_names
+
+
     def gen_get_api(
         self,
         router,
         table_name: str = None,
         *,
         router_kwargs: dict,
+        projection: dict = None,
         request = None,
         x_extra_datas = None,
     ):
         # @self.backend.get(**router_kwargs)
         # def get_func(id: int = Path(...)):
         #     return self.db_adapter.get_data(table_name, query={'id': id})
-        def get_func(
+        version_field = self.db_adapter.version_field
+        if version_field and projection:
+            projection = {**projection, version_field: True}
+
+        async def get_func(
             request: Request,
+            response: Response,
             id: int = Path(...),
+            expand: Optional[str] = Query(None, description='展开的外键字段，逗号分隔'),
             x_extra_datas = XParam(),
         ):
             query = x_extra_datas.get('query', {})
             query.update({'id': id})
-            return self.db_adapter.get_data_by_id(table_name, query=query)
+            use_cache = len(query) == 1     # 只缓存单纯按id的查询
+            d = await self.cache_call(table_name, 'get', str(id)) if use_cache else None
+            if_none_match = request.headers.get('if-none-match')
+            # expand的外键数据不在版本号中，带expand的请求不使用ETag
+            if version_field and if_none_match and not expand:
+                # 只读取版本号，未变化时不读取和序列化数据
+                v = d if d is not None else await self.read_call('get_data_by_id', table_name, query=query, projection={'_id': False, version_field: True})
+                if v is None:
+                    raise HTTPException(status_code=404, detail='数据不存在')
+                etag = x_make_etag(v.get(version_field), self.get_etag_suffix(table_name))
+                if x_etag_matches(if_none_match, etag):
+                    return Response(status_code=304, headers={'ETag': etag})
+            if d is None:
+                # 未命中时先取得租约再读取数据库，期间的修改会使租约失效，旧数据不会被写回缓存
+                token = await self.cache_call(table_name, 'lease', str(id)) if use_cache else None
+                if token is None:
+                    d = await self.read_call('get_data_by_id', table_name, query=query, projection=projection)
+                else:   # 不合并到租约之前开始的查询中
+                    d = await self.db_call('get_data_by_id', table_name, query=query, projection=projection)
+                    if d is not None:
+                        await self.cache_call(table_name, 'set_leased', str(id), token, d)
+            if d is None:
+                raise HTTPException(status_code=404, detail='数据不存在')
+            if version_field and not expand:
+                response.headers['ETag'] = x_make_etag(d.get(version_field), self.get_etag_suffix(table_name))
+            d = (await self.resolve_file_urls(table_name, [d]))[0]
+            if expand:
+                d = (await self.expand_datas(table_name, [d], expand))[0]
+                return XJSONResponse(d, headers=dict(response.headers))
+            if self.fast_response:
+                return XJSONResponse(self.table_dict[table_name]['selector'](d), headers=dict(response.headers))
+            return d
         router.get(**router_kwargs)(get_func)
 
 
@@ -177,17 +647,255 @@ class MFastAPI(MapleApi):
         model_query: BaseModel = None,
         *,
         router_kwargs: dict,
+        projection: dict = None,
+        request = None,
+        x_extra_datas = None,
+    ):
+        @router.get(**router_kwargs)
+        @x_set_query(model_query=model_query, query_ops=self.table_dict[table_name]['query_ops'])
+        async def get_many_func(
+            request: Request,
+            response: Response,
+            limit: Optional[int] = Query(None, ge=1),
+            cursor: Optional[str] = Query(None),
+            expand: Optional[str] = Query(None, description='展开的外键字段，逗号分隔'),
+            sort: Optional[str] = Query(None, description='排序字段，逗号分隔，-表示降序，如-price,name'),
+            fields: Optional[str] = Query(None, description='返回的字段，逗号分隔'),
+            x_extra_datas = XParam(),
+        ):
+            query = x_extra_datas.get('query', {})
+            limit = self.get_page_limit(limit)
+            sort_keys = self.parse_sort(table_name, sort, query)
+            selected = self.parse_fields(table_name, fields)
+            page_projection = utils.get_projection_from_fields(selected) if selected else projection
+            try:
+                after = utils.decode_cursor(cursor) if cursor else None
+                if after is not None and any(f not in after for f, _ in sort_keys):
+                    raise ValueError(f'非法的游标: {cursor}')
+                if after is not None:
+                    after = utils.parse_cursor_values(after, self.table_dict[table_name]['model'], [f for f, _ in sort_keys])
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            async def get_page(page_projection):
+                if limit is None and cursor is None:
+                    return await self.read_call('get_datas', table_name, query=query, projection=page_projection, sort=sort and sort_keys), None
+                # 游标分页，游标中记录上一页最后一条的排序字段值，每页的代价与翻页深度无关
+                page_projection = page_projection and {**page_projection, **{f: True for f, _ in sort_keys}}
+                datas = await self.read_call('get_datas', table_name, query=query, projection=page_projection, sort=sort_keys, limit=limit and limit + 1, after=after)
+                if limit is not None and len(datas) > limit:
+                    datas = datas[:limit]
+                    return datas, utils.encode_cursor({f: datas[-1].get(f) for f, _ in sort_keys})
+                return datas, None
+
+            version_field = self.db_adapter.version_field
+            if_none_match = request.headers.get('if-none-match')
+            if version_field and if_none_match and not expand:
+                # 只读取本页的id和版本号，未变化时不读取和序列化数据
+                versions, next_cursor = await get_page({'_id': False, 'id': True, version_field: True})
+                etag = x_make_list_etag(versions, version_field, next_cursor, self.get_etag_suffix(table_name))
+                if x_etag_matches(if_none_match, etag):
+                    headers = {'ETag': etag, **({'X-Next-Cursor': next_cursor} if next_cursor else {})}
+                    return Response(status_code=304, headers=headers)
+
+            if version_field and page_projection:
+                page_projection = {**page_projection, 'id': True, version_field: True}
+            datas, next_cursor = await get_page(page_projection)
+            if next_cursor:
+                response.headers['X-Next-Cursor'] = next_cursor
+            if version_field and not expand:
+                response.headers['ETag'] = x_make_list_etag(datas, version_field, next_cursor, self.get_etag_suffix(table_name))
+
+            datas = await self.resolve_file_urls(table_name, datas)
+            if expand:
+                datas = await self.expand_datas(table_name, datas, expand)
+            if selected:
+                selector = FieldSelector(self.table_dict[table_name]['model_out'], selected)
+                return XJSONResponse(selector.select(datas), headers=dict(response.headers))
+            if expand:
+                return XJSONResponse(datas, headers=dict(response.headers))
+            if self.fast_response:
+                return XJSONResponse(self.table_dict[table_name]['selector'].select(datas), headers=dict(response.headers))
+            return datas
+
+
+    def gen_count_api(
+        self,
+        router,
+        table_name: str = None,
+        model_query: BaseModel = None,
+        *,
+        router_kwargs: dict,
+        request = None,
+        x_extra_datas = None,
+    ):
+        @router.get(**router_kwargs)
+        @x_set_query(model_query=model_query, query_ops=self.table_dict[table_name]['query_ops'])
+        async def count_func(
+            request: Request,
+            limit: Optional[int] = Query(None, ge=1, description='最多数到limit条'),
+            x_extra_datas = XParam(),
+        ):
+            query = x_extra_datas.get('query', {})
+            count = await self.db_call('count_datas', table_name, query, limit=limit)
+            return {'count': count}
+
+
+    def gen_stats_api(
+        self,
+        router,
+        table_name: str = None,
+        model_query: BaseModel = None,
+        group_fields: list = None,
+        metric_ops: dict = None,
+        *,
+        router_kwargs: dict,
+        request = None,
+        x_extra_datas = None,
+    ):
+        '''
+        统计接口：过滤、分组和聚合都在mongo的聚合管道中完成，只返回聚合结果
+        '''
+        @router.get(**router_kwargs)
+        @x_set_query(model_query=model_query, query_ops=self.table_dict[table_name]['query_ops'])
+        async def stats_func(
+            request: Request,
+            group_by: Optional[str] = Query(None, description=f'分组字段，逗号分隔，可选: {",".join(group_fields)}'),
+            metric: Optional[str] = Query(None, description='聚合，逗号分隔，如count,sum:price，默认count'),
+            x_extra_datas = XParam(),
+        ):
+            query = x_extra_datas.get('query', {})
+            try:
+                keys, metrics = utils.parse_stats(group_by, metric, group_fields, metric_ops)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            max_groups = self.stats_max_groups
+            pipeline = utils.build_stats_pipeline(query, keys, metrics, limit=max_groups and max_groups + 1)
+            rows = await self.db_call('aggregate_datas', table_name, pipeline, allow_disk_use=self.stats_allow_disk_use)
+            if max_groups and len(rows) > max_groups:
+                raise HTTPException(status_code=400, detail=f'分组数超过上限{max_groups}，请增加过滤条件')
+            return [{**(row.pop('_id') or {}), **row} for row in rows]
+
+
+    def gen_search_api(
+        self,
+        router,
+        table_name: str = None,
+        model_query: BaseModel = None,
+        *,
+        router_kwargs: dict,
+        projection: dict = None,
+        request = None,
+        x_extra_datas = None,
+    ):
+        '''
+        全文搜索：$text走x_search字段的文本索引，按相关度排序，游标中记录上一页最后一条的相关度和id
+        '''
+        @router.get(**router_kwargs)
+        @x_set_query(model_query=model_query, query_ops=self.table_dict[table_name]['query_ops'])
+        async def search_func(
+            request: Request,
+            response: Response,
+            q: str = Query(..., min_length=1, description='搜索词，空格分隔，"短语"精确匹配，-排除'),
+            limit: Optional[int] = Query(None, ge=1),
+            cursor: Optional[str] = Query(None),
+            fields: Optional[str] = Query(None, description='返回的字段，逗号分隔'),
+            x_extra_datas = XParam(),
+        ):
+            query = x_extra_datas.get('query', {})
+            limit = self.get_page_limit(limit)
+            selected = self.parse_fields(table_name, fields)
+            page_projection = utils.get_projection_from_fields(selected) if selected else projection
+            try:
+                after = utils.decode_cursor(cursor) if cursor else None
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            if after is not None and any(f not in after for f in ('_score', 'id')):
+                raise HTTPException(status_code=400, detail=f'非法的游标: {cursor}')
+
+            pipeline = utils.build_search_pipeline(q, query, page_projection, limit=limit and limit + 1, after=after)
+            datas = await self.db_call('aggregate_datas', table_name, pipeline)
+            if limit is not None and len(datas) > limit:
+                datas = datas[:limit]
+                response.headers['X-Next-Cursor'] = utils.encode_cursor({f: datas[-1].get(f) for f in ('_score', 'id')})
+            for d in datas:
+                d.pop('_score', None)
+
+            datas = await self.resolve_file_urls(table_name, datas)
+            if selected:
+                selector = FieldSelector(self.table_dict[table_name]['model_out'], selected)
+                return XJSONResponse(selector.select(datas), headers=dict(response.headers))
+            if self.fast_response:
+                return XJSONResponse(self.table_dict[table_name]['selector'].select(datas), headers=dict(response.headers))
+            return datas
+
+
+    def gen_head_api(
+        self,
+        router,
+        table_name: str = None,
+        *,
+        router_kwargs: dict,
+        request = None,
+        x_extra_datas = None,
+    ):
+        @router.head(**router_kwargs)
+        async def head_func(
+            request: Request,
+            id: int = Path(...),
+            x_extra_datas = XParam(),
+        ):
+            query = x_extra_datas.get('query', {})
+            query.update({'id': id})
+            exists = len(query) == 1 and await self.cache_call(table_name, 'get', str(id)) is not None
+            if not exists:
+                exists = await self.db_call('exists_data', table_name, query)
+            return Response(status_code=200 if exists else 404)
+
+
+    def gen_export_api(
+        self,
+        router,
+        table_name: str = None,
+        model_query: BaseModel = None,
+        model_out: BaseModel = None,
+        *,
+        router_kwargs: dict,
+        projection: dict = None,
         request = None,
         x_extra_datas = None,
     ):
+        fields = utils.get_fields_name_from_pydantic_model(model_out)
+        media_types = {
+            'ndjson': 'application/x-ndjson',
+            'csv': 'text/csv',
+        }
+
         @router.get(**router_kwargs)
-        @x_set_query(model_query=model_query)
-        def get_many_func(
+        @x_set_query(model_query=model_query, query_ops=self.table_dict[table_name]['query_ops'])
+        async def export_func(
             request: Request,
+            format: str = Query('ndjson', regex='^(ndjson|csv)$'),
             x_extra_datas = XParam(),
         ):
             query = x_extra_datas.get('query', {})
-            return self.db_adapter.get_datas(table_name, query=query)
+
+            async def gen_content():
+                # 边读边写，不构建完整列表，也不经过response_model校验
+                if format == 'csv':
+                    yield utils.dumps_csv([], fields, header=True)
+                batches = iterate_adapter(self.db_adapter, 'iter_datas', table_name, query, projection=projection, sort=[('id', 1)], batch_size=self.export_batch_size)
+                async for batch in batches:
+                    if format == 'csv':
+                        yield utils.dumps_csv(batch, fields)
+                    else:
+                        yield utils.dumps_ndjson(batch, fields)
+
+            return StreamingResponse(
+                gen_content(),
+                media_type=media_types[format],
+                headers={'Content-Disposition': f'attachment; filename="{table_name}s.{format}"'},
+            )
 
 
     def gen_post_api(
@@ -201,20 +909,272 @@ class MFastAPI(MapleApi):
         request = None,
         x_extra_datas = None,
     ):
-        try:    # mongo数据库
-            from pymongo.database import Database
-            if isinstance(self.get_db_client(), Database):
-                @router.post(**router_kwargs)
-                @x_set_mongo_in(database=self.get_db_client(), model_db=model_db, database_id_auto_incr=self.database_id_auto_incr)
-                def post_func(
-                    m: model_in,
-                    request: Request,
-                    x_extra_datas = XParam(),
-                ):
-                    self.db_adapter.create_data(table_name, m)
-                    return model_db(**m.dict())
-        except:
-            ...
+        if self.write_batch_conf and hasattr(self.db_adapter, 'create_datas'):
+            self.gen_batch_post_api(router, table_name, model_in, model_db, router_kwargs=router_kwargs)
+        elif hasattr(self.db_adapter, 'inc_counter_id'):    # mongo数据库（同步/异步）
+            @router.post(**router_kwargs)
+            @x_set_mongo_in(id_generator=self.id_generator, model_db=model_db, database_id_auto_incr=self.database_id_auto_incr)
+            async def post_func(
+                m: model_in,
+                request: Request,
+                x_extra_datas = XParam(),
+            ):
+                if self.fast_response:
+                    d = m.dict()
+                    await self.db_call('create_data', table_name, d)
+                    return XJSONResponse(self.table_dict[table_name]['selector'](d))
+                await self.db_call('create_data', table_name, m)
+                return model_db(**m.dict())
+
+
+    def gen_batch_post_api(
+        self,
+        router,
+        table_name: str = None,
+        model_in: BaseModel = None,
+        model_db: BaseModel = None,
+        *,
+        router_kwargs: dict,
+        request = None,
+        x_extra_datas = None,
+    ):
+        '''
+        并发的单条新增在WriteBatcher中合并，每批只分配一次id、执行一次insert_many
+        '''
+        use_id_generator = self.database_id_auto_incr and 'id' in model_db.__fields__
+
+        async def flush(datas: list) -> list:
+            results = [None] * len(datas)
+            if use_id_generator:
+                ids = await self.id_generator.async_get_ids(model_db.__name__, len(datas))
+                datas = [{**d, 'id': id} for d, id in zip(datas, ids)]
+            docs, indexes = [], []
+            for i, d in enumerate(datas):
+                try:
+                    docs.append(model_db(**d).dict())
+                    indexes.append(i)
+                except ValidationError as e:
+                    results[i] = HTTPException(status_code=422, detail=e.errors())
+            ret = await self.db_call('create_datas', table_name, docs, chunk_size=self.bulk_chunk_size)
+            errors = {err['index']: err for err in ret['errors']}
+            for j, (i, doc) in enumerate(zip(indexes, docs)):
+                err = errors.get(j)
+                if err is None:
+                    results[i] = doc
+                elif err['code'] == 11000:
+                    results[i] = HTTPException(status_code=409, detail=err['errmsg'])
+                else:
+                    results[i] = HTTPException(status_code=500, detail=err['errmsg'])
+            return results
+
+        batcher = WriteBatcher(flush, **self.write_batch_conf)
+        self.batcher_dict[table_name] = batcher
+
+        @router.post(**router_kwargs)
+        async def batch_post_func(
+            m: model_in,
+            request: Request,
+            x_extra_datas = XParam(),
+        ):
+            d = await batcher.submit(m.dict())
+            if self.fast_response:
+                return XJSONResponse(self.table_dict[table_name]['selector'](d))
+            return model_db(**d)
+
+
+    def gen_bulk_post_api(
+        self,
+        router,
+        table_name: str = None,
+        model_in: BaseModel = None,
+        model_db: BaseModel = None,
+        *,
+        router_kwargs: dict,
+        request = None,
+        x_extra_datas = None,
+    ):
+        if not hasattr(self.db_adapter, 'create_datas'):
+            return
+        use_id_generator = self.database_id_auto_incr and 'id' in model_db.__fields__
+
+        @router.post(**router_kwargs)
+        async def bulk_post_func(
+            request: Request,
+            x_extra_datas = XParam(),
+        ):
+            '''
+            请求体为列表(application/json)或每行一条的NDJSON(application/x-ndjson)
+            '''
+            items = await x_read_bulk_body(request, self.bulk_max_items)
+
+            # 逐条校验，失败的记录错误，不影响其他数据
+            valid, errors = [], []
+            for i, item in enumerate(items):
+                try:
+                    valid.append((i, model_in.parse_obj(item)))
+                except ValidationError as e:
+                    errors.append({'index': i, 'error': e.errors()})
+
+            # 一次性分配所有id
+            ids = await self.id_generator.async_get_ids(model_db.__name__, len(valid)) if use_id_generator and valid else []
+            indexes, docs = [], []
+            for n, (i, m) in enumerate(valid):
+                try:
+                    docs.append((model_db(**{**m.dict(), 'id': ids[n]}) if use_id_generator else m).dict())
+                    indexes.append(i)
+                except ValidationError as e:
+                    errors.append({'index': i, 'error': e.errors()})
+
+            result = await self.db_call('create_datas', table_name, docs, chunk_size=self.bulk_chunk_size)
+            failed = set()
+            for err in result['errors']:
+                failed.add(err['index'])
+                errors.append({'index': indexes[err['index']], 'error': err['errmsg'], 'code': err['code']})
+            return {
+                'inserted_count': result['inserted_count'],
+                'ids': [doc.get('id') for n, doc in enumerate(docs) if n not in failed],
+                'errors': sorted(errors, key=lambda e: e['index']),
+            }
+
+
+    def gen_bulk_put_api(
+        self,
+        router,
+        table_name: str = None,
+        model_put: BaseModel = None,
+        model_query: BaseModel = None,
+        *,
+        router_kwargs: dict,
+        request = None,
+        x_extra_datas = None,
+    ):
+        @router.put(**router_kwargs)
+        async def bulk_put_func(
+            request: Request,
+            x_extra_datas = XParam(),
+        ):
+            '''
+            请求体: [{"id": 1, "data": {...}}, [2, {...}], ...]
+            允许按条件修改时: {"filter": {...}, "data": {...}}
+            '''
+            body = await x_read_json_body(request)
+            if isinstance(body, dict):
+                query, data = self.parse_bulk_filter(body, model_query), x_parse_model(model_put, body.get('data'))
+                ret = await self.db_call('update_datas', table_name, query, data.dict())
+                await self.cache_call(table_name, 'clear')
+                return {'matched_count': ret.matched_count, 'modified_count': ret.modified_count, 'errors': []}
+
+            items = x_check_bulk_items(body, self.bulk_max_items)
+            datas, errors = [], []
+            for i, item in enumerate(items):
+                try:
+                    id, data = (item.get('id'), item.get('data')) if isinstance(item, dict) else item
+                    datas.append((int(id), model_put.parse_obj(data).dict()))
+                except ValidationError as e:
+                    errors.append({'index': i, 'error': e.errors()})
+                except (TypeError, ValueError):
+                    errors.append({'index': i, 'error': '应为{"id": id, "data": {...}}或[id, {...}]'})
+            invalid = {e['index'] for e in errors}
+            indexes = [i for i in range(len(items)) if i not in invalid]
+
+            result = await self.db_call('bulk_update_data_by_id', table_name, datas, chunk_size=self.bulk_chunk_size)
+            for id, _ in datas:
+                await self.cache_call(table_name, 'delete', str(id))
+            for err in result['errors']:
+                errors.append({'index': indexes[err['index']], 'error': err['errmsg'], 'code': err['code']})
+            result['errors'] = sorted(errors, key=lambda e: e['index'])
+            return result
+
+
+    def gen_bulk_delete_api(
+        self,
+        router,
+        table_name: str = None,
+        model_query: BaseModel = None,
+        *,
+        router_kwargs: dict,
+        request = None,
+        x_extra_datas = None,
+    ):
+        @router.delete(**router_kwargs)
+        async def bulk_delete_func(
+            request: Request,
+            x_extra_datas = XParam(),
+        ):
+            '''
+            请求体: [1, 2, 3, ...]
+            允许按条件删除时: {"filter": {...}}
+            '''
+            body = await x_read_json_body(request)
+            if isinstance(body, dict):
+                query = self.parse_bulk_filter(body, model_query)
+                deleted_count = await self.delete_with_file_refs(table_name, query)
+                if deleted_count is None:
+                    deleted_count = (await self.db_call('delete_datas', table_name, query)).deleted_count
+                await self.cache_call(table_name, 'clear')
+                return {'deleted_count': deleted_count}
+
+            items = x_check_bulk_items(body, self.bulk_max_items)
+            try:
+                ids = [int(id) for id in items]
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=400, detail='请求体应为id列表')
+            deleted_count = await self.delete_with_file_refs(table_name, {'id': {'$in': ids}})
+            if deleted_count is None:
+                result = await self.db_call('bulk_delete_data_by_id', table_name, ids, chunk_size=self.bulk_chunk_size)
+            else:
+                result = {'deleted_count': deleted_count}
+            for id in ids:
+                await self.cache_call(table_name, 'delete', str(id))
+            return result
+
+
+    def parse_sort(self, table_name: str, sort: Optional[str], query: dict) -> list:
+        '''
+        校验列表接口的排序，只允许可排序字段，且必须有索引支持该排序，避免在内存中排序
+        未传sort时按id升序
+        '''
+        if not sort:
+            return [('id', 1)]
+        meta = utils.get_model_meta(self.table_dict[table_name]['model'])
+        try:
+            sort_keys = utils.parse_sort(sort, meta.sort_fields)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        # 被等值条件固定的字段可以跳过索引开头
+        eq_fields = {f for f, v in query.items() if not isinstance(v, dict) or list(v) == ['$eq']}
+        index_specs = self.existing_index_dict.get(table_name)
+        if index_specs is None:
+            raise HTTPException(status_code=400, detail=f'尚未读取数据库中的索引，不支持排序: {sort}')
+        if utils.index_supports_sort(sort_keys, index_specs, eq_fields):
+            return sort_keys
+        raise HTTPException(status_code=400, detail=f'没有支持该排序的索引: {sort}，需要索引: {sort_keys}')
+
+
+    def parse_fields(self, table_name: str, fields: Optional[str]) -> Optional[list]:
+        '''
+        校验列表接口的字段选择，只允许_Out模型中的字段
+        '''
+        if not fields:
+            return None
+        out_fields = list(self.table_dict[table_name]['model_out'].__fields__)
+        selected = [f for f in fields.split(',') if f]
+        invalid = [f for f in selected if f not in out_fields]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f'不能选择的字段: {invalid}，可选: {out_fields}')
+        return selected
+
+
+    def parse_bulk_filter(self, body: dict, model_query: BaseModel) -> dict:
+        '''
+        校验批量接口的过滤条件，只允许_Query模型中的字段，且不允许为空
+        '''
+        if not self.allow_bulk_filter_write:
+            raise HTTPException(status_code=403, detail='未开启按条件批量修改/删除')
+        query = x_parse_model(model_query, body.get('filter')).dict(exclude_none=True)
+        if not query:
+            raise HTTPException(status_code=400, detail='过滤条件不能为空')
+        return query
 
 
     def gen_delete_api(
@@ -227,14 +1187,16 @@ class MFastAPI(MapleApi):
         x_extra_datas = None,
     ):
         @router.delete(**router_kwargs)
-        def delete_func(
+        async def delete_func(
             request: Request,
             id: int = Path(...),
             x_extra_datas = XParam(),
         ):
             query = x_extra_datas.get('query', {})
             query.update({'id': id})
-            self.db_adapter.delete_data_by_id(table_name, query)
+            if await self.delete_with_file_refs(table_name, query) is None:
+                await self.db_call('delete_data_by_id', table_name, query)
+            await self.cache_call(table_name, 'delete', str(id))
             return {'id': id}
 
 
@@ -245,20 +1207,57 @@ class MFastAPI(MapleApi):
         model_put: BaseModel = None,
         *,
         router_kwargs: dict,
+        projection: dict = None,
         request = None,
         x_extra_datas = None,
     ):
-        @router.put(**router_kwargs)
-        def put_func(
+        '''
+        PUT和PATCH：只写入请求中给出的字段，一次find_one_and_update完成修改并返回修改后的数据
+        显式传null的字段只允许是数据库模型中可为None的字段
+        '''
+        version_field = self.db_adapter.version_field
+        if version_field and projection:
+            projection = {**projection, version_field: True}
+        model = self.table_dict[table_name]['model']
+        nullable_fields = {name for name, field in model.__fields__.items() if field.allow_none}
+
+        async def put_func(
             request: Request,
+            response: Response,
             m: model_put,
             id: int = Path(...),
             x_extra_datas = XParam(),
         ):
             query = x_extra_datas.get('query', {})
             query.update({'id': id})
-            self.db_adapter.update_data_by_id(table_name, query, m)
-            return {}
+            data = m.dict(exclude_unset=True)
+            invalid = [k for k, v in data.items() if v is None and k not in nullable_fields]
+            if invalid:
+                raise HTTPException(status_code=422, detail=f'字段不能为null: {", ".join(invalid)}')
+            if_match = request.headers.get('if-match')
+            if version_field and if_match:
+                # 乐观并发控制：版本号条件和修改在同一次find_one_and_update中完成
+                versions = x_parse_etag_versions(if_match)
+                if versions is not None:
+                    if 0 in versions:   # 版本号0对应没有版本号的数据，$in中的None匹配字段缺失或为null
+                        versions = versions + [None]
+                    query[version_field] = {'$in': versions}
+            d = await self.db_call('find_and_update_data', table_name, query, data, projection=projection, trim_none=False)
+            if d is None:
+                if version_field in query:
+                    query.pop(version_field)
+                    if await self.db_call('exists_data', table_name, query):
+                        raise HTTPException(status_code=412, detail='数据已被修改')
+                raise HTTPException(status_code=404, detail='数据不存在')
+            await self.cache_call(table_name, 'delete', str(id))
+            if version_field:
+                response.headers['ETag'] = x_make_etag(d.get(version_field), self.get_etag_suffix(table_name))
+            d = (await self.resolve_file_urls(table_name, [d]))[0]
+            if self.fast_response:
+                return XJSONResponse(self.table_dict[table_name]['selector'](d), headers=dict(response.headers))
+            return d
+        router.put(**router_kwargs)(put_func)
+        router.patch(**router_kwargs)(put_func)
 
 
     def gen_upload_api(
@@ -272,7 +1271,7 @@ class MFastAPI(MapleApi):
         x_extra_datas = None,
     ):
         @router.put(**router_kwargs)
-        def upload_func(
+        async def upload_func(
             request: Request,
             id: int = Path(...),
             file: UploadFile = File(...),
@@ -280,12 +1279,101 @@ class MFastAPI(MapleApi):
         ):
             query = x_extra_datas.get('query', {})
             query.update({'id': id})
-            file_name = self.sto_adapter.upload_object(file.file, file_name=file.filename)
-            file_url = self.sto_adapter.get_object_url(file_name)
-            self.db_adapter.update_data_by_id(table_name, query, {update_filed_name: file_url})
+            if self.sto_adapter.dedup:
+                return await self.upload_dedup(table_name, update_filed_name, query, file)
+            try:
+                file_name = await self.sto_call(
+                    'upload_object', file.file, file_name=file.filename, content_type=file.content_type)
+            except ObjectTooLargeError as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            # presigned模式只保存对象名，读取时再签名
+            file_url = file_name if self.sto_adapter.url_mode == 'presigned' else self.sto_adapter.get_object_url(file_name)
+            await self.db_call('update_data_by_id', table_name, query, {update_filed_name: file_url})
+            await self.cache_call(table_name, 'delete', str(id))
             return {}
 
 
+    async def upload_dedup(self, table_name: str, field_name: str, query: dict, file: UploadFile):
+        '''
+        去重上传：先占用新对象的引用再判断对象是否存在，
+        修改时原子地取回被替换的旧值，只释放这次修改实际替换的对象
+        '''
+        if not await self.db_call('exists_data', table_name, query):
+            raise HTTPException(status_code=404, detail='数据不存在')
+        try:
+            file_name = await self.sto_call('get_dedup_object_name', file.file, ext=os.path.splitext(file.filename or '')[1])
+        except ObjectTooLargeError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        await self.reserve_file_ref(file_name)
+        try:
+            await self.sto_call('put_object_if_missing', file.file, file_name, content_type=file.content_type)
+            # presigned模式只保存对象名，读取时再签名
+            file_url = file_name if self.sto_adapter.url_mode == 'presigned' else self.sto_adapter.get_object_url(file_name)
+            old = await self.db_call('find_and_update_data', table_name, query, {field_name: file_url},
+                projection={field_name: True, '_id': False}, return_before=True)
+        except BaseException:
+            await self.update_file_refs(removed=[file_name])
+            raise
+        if old is None:
+            await self.update_file_refs(removed=[file_name])
+            raise HTTPException(status_code=404, detail='数据不存在')
+        await self.cache_call(table_name, 'delete', str(query['id']))
+        if old.get(field_name):
+            await self.update_file_refs(removed=[self.sto_adapter.get_object_name(old[field_name])])
+        return {}
+
+
+    def gen_download_api(
+        self,
+        router,
+        table_name: str = None,
+        field_name: str = None,
+        *,
+        router_kwargs: dict,
+        request = None,
+        x_extra_datas = None,
+    ):
+        @router.get(**router_kwargs)
+        async def download_func(
+            request: Request,
+            id: int = Path(...),
+            x_extra_datas = XParam(),
+        ):
+            query = x_extra_datas.get('query', {})
+            query.update({'id': id})
+            d = await self.db_call('get_data_by_id', table_name, query, {field_name: True, '_id': False})
+            if not d or not d.get(field_name):
+                raise HTTPException(status_code=404, detail='文件不存在')
+            object_name = self.sto_adapter.get_object_name(d[field_name])
+            stat = await self.sto_call('stat_object', object_name)
+            if stat is None:
+                raise HTTPException(status_code=404, detail='文件不存在')
+
+            size = stat.size
+            headers = {'Accept-Ranges': 'bytes'}
+            if stat.etag:
+                headers['ETag'] = f'"{stat.etag}"'
+            try:
+                byte_range = utils.parse_range_header(request.headers.get('range'), size)
+            except ValueError as e:
+                raise HTTPException(status_code=416, detail=str(e), headers={'Content-Range': f'bytes */{size}'})
+            if byte_range is None:
+                status_code, offset, length = 200, 0, size
+            else:
+                status_code, offset, length = 206, byte_range[0], byte_range[1] - byte_range[0] + 1
+                headers['Content-Range'] = f'bytes {byte_range[0]}-{byte_range[1]}/{size}'
+            headers['Content-Length'] = str(length)
+
+            # 边读边发，读完或客户端断开时关闭生成器，将连接归还给连接池
+            content = iterate_adapter(self.sto_adapter, 'iter_object', object_name, offset, length) if length else iter([])
+            return StreamingResponse(
+                content,
+                status_code=status_code,
+                media_type=stat.content_type or 'application/octet-stream',
+                headers=headers,
+            )
+
+
 class XParamClass(Param):
     in_: ParamTypes = ParamTypes.query
 
@@ -376,9 +1464,99 @@ def get_request(request_dict):
     return None
 
 
+async def x_read_json_body(request: Request):
+    '''
+    读取JSON请求体，支持NDJSON（解析为列表）
+    '''
+    try:
+        if request.headers.get('content-type', '').startswith('application/x-ndjson'):
+            body = (await request.body()).decode()
+            return [json.loads(line) for line in body.splitlines() if line.strip()]
+        return await request.json()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f'请求体解析失败: {e}')
+
+
+def x_check_bulk_items(items, max_items: int = None) -> list:
+    '''
+    检查批量接口的请求体为列表且不超过最大条数
+    '''
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail='请求体应为列表')
+    if max_items and len(items) > max_items:
+        raise HTTPException(status_code=413, detail=f'单次最多{max_items}条')
+    return items
+
+
+async def x_read_bulk_body(request: Request, max_items: int = None) -> list:
+    '''
+    读取批量接口的请求体，支持JSON列表和NDJSON
+    '''
+    return x_check_bulk_items(await x_read_json_body(request), max_items)
+
+
+def x_make_etag(version, suffix: str = '') -> str:
+    '''
+    由版本号生成弱ETag（同一版本的数据可能有不同的表示，如fields）
+    suffix: 版本号之外影响响应内容的部分，如预签名地址的签名窗口
+    开启version_field之前写入的数据没有版本号，按0处理
+    '''
+    return f'W/"{0 if version is None else version}{suffix}"'
+
+
+def x_make_list_etag(datas: list, version_field: str, next_cursor: str = None, suffix: str = '') -> str:
+    '''
+    由本页每条数据的id和版本号生成列表的ETag，数据增删改都会改变ETag
+    '''
+    s = json.dumps([[d.get('id'), d.get(version_field)] for d in datas] + [next_cursor], default=str, separators=(',', ':'))
+    return x_make_etag(hashlib.md5(s.encode()).hexdigest(), suffix)
+
+
+def x_etag_matches(header: str, etag: str) -> bool:
+    '''
+    If-None-Match是否命中，按弱比较（忽略W/前缀）
+    '''
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or x_strip_weak(etag) in (x_strip_weak(tag) for tag in tags)
+
+
+def x_strip_weak(tag: str) -> str:
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def x_parse_etag_versions(header: str) -> Optional[list]:
+    '''
+    从If-Match中解析版本号列表，*返回None（只要求数据存在）
+    '''
+    versions = []
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return None
+        try:
+            versions.append(int(x_strip_weak(tag).strip('"').split('-')[0]))
+        except ValueError:
+            pass
+    return versions
+
+
+def x_parse_model(model: BaseModel, data):
+    '''
+    校验请求体中的数据，失败时返回422
+    '''
+    try:
+        return model.parse_obj(data)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+
+
 def x_set_query(
     model_query: BaseModel = None,
+    query_ops: dict = None,
 ):
+    '''
+    query_ops: 允许的过滤操作符 {field: (ops, type_)}，见utils.get_query_ops_from_pydantic_model
+    '''
     def func_decorator(func):
         @wraps(func)
         async def func_wrap(*args, **kwargs):
@@ -388,54 +1566,63 @@ def x_set_query(
 
                 request = get_request(kwargs)
                 query_params = dict(request.query_params)
+                ops_params = [(k, v) for k, v in request.query_params.multi_items() if '__' in k]
 
-                x_extra_datas['query'] = model_query(**query_params).dict(exclude_none=True)
+                try:
+                    query = model_query(**query_params).dict(exclude_none=True)
+                except ValidationError as e:
+                    raise HTTPException(status_code=422, detail=e.errors())
+                if ops_params:
+                    filters, invalid, errors = utils.build_query_filters(query_ops or {}, ops_params)
+                    if invalid:
+                        allowed = [f'{field}__{op}' for field, (ops, _) in (query_ops or {}).items() for op in ops]
+                        raise HTTPException(status_code=400, detail=f'不支持的过滤条件: {invalid}，可用: {allowed}')
+                    if errors:
+                        raise HTTPException(status_code=422, detail=errors)
+                    for field, cond in filters.items():
+                        if field in query:
+                            cond = {'$eq': query[field], **cond}
+                        query[field] = cond
+                x_extra_datas['query'] = query
 
             # print(kwargs)
 
-            ret_api = func(*args, **kwargs)
+            ret_api = await x_call(func, *args, **kwargs)
             return ret_api
         return func_wrap
     return func_decorator
 
 
 def x_set_mongo_in(
-    database,
+    id_generator,
     model_db,
     database_id_auto_incr = True,
 ):
+    has_id = 'id' in utils.get_model_meta(model_db).field_names
+
     def func_decorator(func):
         @wraps(func)
         async def func_wrap(*args, **kwargs):
             if 'm' in kwargs:
-                try:    # 如果是mongo数据库，且带id字段，使用自增
-                    from pymongo.database import Database
-                    if isinstance(database, Database):
-                        if database_id_auto_incr:
-                            def get_and_inc_collection_counter_id(db: Database, collection_name='test') -> int:
-                                result = db['counter_id'].find_one_and_update(
-                                    {'collection': collection_name},    # 查询
-                                    {'$inc': {'id': 1}},                # 递增字段
-                                    upsert=True,                        # 如果不存在，将新建
-                                    projection={'id': True, '_id': False},  # 返回的字段
-                                    return_document=True,               # 返回递增前(False)，还是递增后(True)的结果
-                                )
-                                return result.get('id')
-                        
-                            m = kwargs.get('m', None)
-                            if 'id' not in m.dict() and 'id' in model_db.schema()['properties']:
-                                new_m = model_db(**m.dict(), id=get_and_inc_collection_counter_id(database, model_db.__name__))
-                            elif 'id' in new_m.dict():
-                                new_m = model_db(**m.dict())
-                                new_m.id = get_and_inc_collection_counter_id(database, model_db.__name__)
-                            kwargs['m'] = new_m
-
-                except:
-                    ...
+                # 如果是mongo数据库，且带id字段，使用id生成器
+                if database_id_auto_incr and id_generator is not None:
+                    m = kwargs.get('m', None)
+                    if has_id:
+                        new_id = await id_generator.async_get_id(model_db.__name__)
+                        kwargs['m'] = model_db(**{**m.dict(), 'id': new_id})
 
                 # print(kwargs)
 
-            ret_api = func(*args, **kwargs)
+            ret_api = await x_call(func, *args, **kwargs)
             return ret_api
         return func_wrap
     return func_decorator
+
+
+async def x_call(func, *args, **kwargs):
+    '''
+    调用被装饰的接口函数：协程直接await，普通函数放入线程池执行
+    '''
+    if inspect.iscoroutinefunction(func):
+        return await func(*args, **kwargs)
+    return await run_sync(func, *args, **kwargs)
@@ -0,0 +1,61 @@
+import json
+import base64
+from datetime import datetime, date
+from pydantic import BaseModel
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    '''
+    序列化json不支持的数据库类型，如ObjectId、Decimal128
+    '''
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode()
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    return str(obj)
+
+
+def dumps(content) -> bytes:
+    '''
+    序列化为json，安装了orjson时使用orjson
+    '''
+    if orjson is not None:
+        return orjson.dumps(content, default=default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class XJSONResponse(JSONResponse):
+    '''
+    直接序列化数据库文档的响应，不经过response_model校验
+    '''
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+class FieldSelector:
+    '''
+    预先编译模型的输出字段和默认值，从数据库文档中选取字段，结果与response_model过滤后一致
+    '''
+    def __init__(self, m: BaseModel, fields: list = None):
+        '''
+        fields: 只选取其中的字段（按模型中的顺序）
+        '''
+        self.fields = [
+            (name, field.alias, None if field.required else field.default)
+            for name, field in m.__fields__.items()
+            if fields is None or name in fields
+        ]
+
+    def __call__(self, d: dict) -> dict:
+        return {alias: d.get(name, value) for name, alias, value in self.fields}
+
+    def select(self, datas: list) -> list:
+        return [self(d) for d in datas]
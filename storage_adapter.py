@@ -1,10 +1,31 @@
+class ObjectTooLargeError(ValueError):
+    '''
+    上传的文件超过存储配置的max_size
+    '''
+    def __init__(self, max_size):
+        super().__init__(f'文件大小超过限制: {max_size}')
+        self.max_size = max_size
+
+
 class StorageAdapter:
+    url_mode = 'stored'     # stored: 数据库中保存文件地址; presigned: 保存对象名，读取时生成预签名地址
+    dedup = False           # 为True时按内容去重，同一对象被多条数据引用，由引用计数决定何时删除
+
     def get_client(self):
         ...
 
     def upload_object(self, file):
         ...
 
+    def get_dedup_object_name(self, file, prefix='', ext=''):
+        ...
+
+    def put_object_if_missing(self, file, object_name):
+        ...
+
+    def remove_object(self, object_name):
+        ...
+
     def get_object(self, object_name):
         ...
 
@@ -13,3 +34,18 @@ class StorageAdapter:
 
     def get_object_url(self, object_name):
         ...
+
+    def get_object_urls(self, object_names):
+        ...
+
+    def get_presigned_window(self):
+        ...
+
+    def stat_object(self, object_name):
+        ...
+
+    def iter_object(self, object_name, offset=0, length=0):
+        ...
+
+    def get_object_name(self, file_url):
+        ...
@@ -1,23 +1,79 @@
 from minio import Minio
-from minio.error import InvalidResponseError
+from minio.commonconfig import ComposeSource
+from minio.error import InvalidResponseError, S3Error
 import os
-from datetime import timedelta
+import hashlib
+import time
+from datetime import datetime, timedelta, timezone
 from uuid import uuid4
+from urllib.parse import urlparse, unquote
 import json
 
-from .storage_adapter import StorageAdapter
+from .storage_adapter import StorageAdapter, ObjectTooLargeError
+from .cache import LRUCache
+
+
+class SizeLimitedReader:
+    '''
+    包装文件对象，读取的字节数超过max_size时抛出ObjectTooLargeError
+    传入hasher（如hashlib.sha256()）时，边读边计算摘要
+    '''
+    def __init__(self, file, max_size=None, hasher=None):
+        self.file = file
+        self.max_size = max_size
+        self.hasher = hasher
+        self.size = 0
+
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ObjectTooLargeError(self.max_size)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        return data
+
 
 class MinioAdapter(StorageAdapter):
-    def __init__(self, url, bucket, access_key, secret_key, secure, policy, **kwargs):
+    def __init__(
+        self, url, bucket, access_key, secret_key, secure, policy,
+        part_size=10 * 1024 * 1024, num_parallel_uploads=1, max_size=None,
+        download_chunk_size=1024 * 1024, region=None, url_mode='stored',
+        presigned_expires=timedelta(days=7), presigned_min_remaining=None, presigned_cache_size=10000,
+        dedup=False, **kwargs,
+    ):
+        '''
+        part_size: 分片上传每片的字节数，不小于5MiB
+        num_parallel_uploads: 并行上传的分片数，内存占用约为part_size * num_parallel_uploads
+        max_size: 单个文件的最大字节数，None表示不限制
+        download_chunk_size: 下载接口每次从对象读取的字节数
+        region: 指定后签名时不再请求bucket所在的region
+        url_mode: stored: 上传时保存文件地址; presigned: 保存对象名，读取时生成预签名地址（私有bucket）
+        presigned_expires: 预签名地址的有效期
+        presigned_min_remaining: 复用缓存的预签名地址时至少剩余的有效期，默认为有效期的一半
+        presigned_cache_size: 预签名地址缓存的条数
+        dedup: 按内容去重，以文件的sha256作为对象名，已存在时不再上传（引用计数由MFastAPI维护）
+        '''
         self.client = Minio(
             url,
             access_key=access_key,
             secret_key=secret_key,
-            secure=secure
+            secure=secure,
+            region=region,
         )
         self.url = url
         self.bucket = bucket
         self.policy = policy
+        self.part_size = part_size
+        self.num_parallel_uploads = num_parallel_uploads
+        self.max_size = max_size
+        self.download_chunk_size = download_chunk_size
+        self.url_mode = url_mode
+        self.presigned_expires = presigned_expires
+        self.presigned_min_remaining = presigned_min_remaining
+        self.presigned_cache = LRUCache(maxsize=presigned_cache_size, ttl=None)
+        self.dedup = dedup
 
         try:
             if not self.client.bucket_exists(bucket):
@@ -77,19 +133,98 @@ class MinioAdapter(StorageAdapter):
         return self.client
 
 
-    def upload_object(self, file, prefix='', bucket_name=None, use_uuid=True, file_name=None):
+    def upload_object(self, file, prefix='', bucket_name=None, use_uuid=True, file_name=None, content_type=None):
+        '''
+        以未知长度的分片方式流式上传，不需要文件的大小（不调用fileno，上传的临时文件不会被写入磁盘）
+        超过max_size时抛出ObjectTooLargeError，并中止已开始的分片上传
+        开启dedup时按内容去重，返回的对象名为内容的sha256
+        '''
         bucket_name = bucket_name or self.bucket
         try:
-            file_size = os.fstat(file.fileno()).st_size
-            file_name = file_name or str(file.name)
+            file_name = file_name or str(getattr(file, 'name', ''))
+            if self.dedup:
+                return self.upload_object_dedup(file, prefix, bucket_name, os.path.splitext(file_name)[1], content_type)
             file_name = (f'{uuid4()}{os.path.splitext(str(file_name))[1]}' if use_uuid else file_name) if file_name else f'{uuid4()}'
             file_name = os.path.join(prefix, file_name)
-            self.client.put_object(bucket_name, file_name, file, file_size)
+            self.put_stream(file, file_name, bucket_name, content_type)
             return file_name
         except InvalidResponseError as e:
             raise e
 
 
+    def put_stream(self, file, object_name, bucket_name, content_type=None, hasher=None):
+        self.client.put_object(
+            bucket_name, object_name, SizeLimitedReader(file, self.max_size, hasher), -1,
+            content_type=content_type or 'application/octet-stream',
+            part_size=self.part_size,
+            num_parallel_uploads=self.num_parallel_uploads,
+        )
+
+
+    def upload_object_dedup(self, file, prefix, bucket_name, ext='', content_type=None):
+        '''
+        可seek的文件（如UploadFile）先在本地计算摘要，对象已存在时跳过上传
+        不可seek的流边上传到临时对象边计算摘要，再在服务端复制为内容地址，不重复传输
+        '''
+        try:
+            position = file.tell()
+            file.seek(position)
+        except (AttributeError, OSError):
+            position = None
+
+        if position is not None:
+            object_name = self.get_dedup_object_name(file, prefix, ext)
+            self.put_object_if_missing(file, object_name, bucket_name, content_type)
+            return object_name
+
+        hasher = hashlib.sha256()
+        tmp_name = os.path.join(prefix, f'tmp-{uuid4()}')
+        self.put_stream(file, tmp_name, bucket_name, content_type, hasher)
+        try:
+            object_name = os.path.join(prefix, f'{hasher.hexdigest()}{ext}')
+            if self.stat_object(object_name, bucket_name) is None:
+                self.client.compose_object(bucket_name, object_name, [ComposeSource(bucket_name, tmp_name)])
+        finally:
+            self.client.remove_object(bucket_name, tmp_name)
+        return object_name
+
+
+    def get_dedup_object_name(self, file, prefix='', ext='') -> str:
+        '''
+        按内容计算去重的对象名（sha256），file需可seek，计算后回到原位置
+        '''
+        position = file.tell()
+        digest = self.hash_object(file)
+        file.seek(position)
+        return os.path.join(prefix, f'{digest}{ext}')
+
+
+    def put_object_if_missing(self, file, object_name, bucket_name=None, content_type=None):
+        '''
+        对象不存在时才上传（去重），返回是否上传
+        '''
+        bucket_name = bucket_name or self.bucket
+        if self.stat_object(object_name, bucket_name) is not None:
+            return False
+        self.put_stream(file, object_name, bucket_name, content_type)
+        return True
+
+
+    def hash_object(self, file, chunk_size=1024 * 1024) -> str:
+        '''
+        计算文件的sha256，超过max_size时抛出ObjectTooLargeError
+        '''
+        reader = SizeLimitedReader(file, self.max_size, hashlib.sha256())
+        while reader.read(chunk_size):
+            pass
+        return reader.hasher.hexdigest()
+
+
+    def remove_object(self, object_name, bucket_name=None):
+        bucket_name = bucket_name or self.bucket
+        self.client.remove_object(bucket_name, object_name)
+
+
     def get_object(self, object_name, bucket_name=None):
         bucket_name = bucket_name or self.bucket
         try:
@@ -100,17 +235,106 @@ class MinioAdapter(StorageAdapter):
 
     def get_object_content(self, object_name, bucket_name=None):
         bucket_name = bucket_name or self.bucket
-        return self.get_object(object_name, bucket_name).data
+        response = self.get_object(object_name, bucket_name)
+        try:
+            return response.data
+        finally:
+            response.close()
+            response.release_conn()
+
+
+    def stat_object(self, object_name, bucket_name=None):
+        '''
+        获取对象的大小、etag、content_type等信息，对象不存在时返回None
+        '''
+        bucket_name = bucket_name or self.bucket
+        try:
+            return self.client.stat_object(bucket_name, object_name)
+        except S3Error as e:
+            if e.code in ('NoSuchKey', 'NoSuchObject', 'NoSuchBucket'):
+                return None
+            raise e
+
+
+    def iter_object(self, object_name, offset=0, length=0, bucket_name=None, chunk_size=None):
+        '''
+        分块读取对象（length为0表示读到末尾），读完或生成器关闭时将连接归还给连接池
+        '''
+        bucket_name = bucket_name or self.bucket
+        response = self.client.get_object(bucket_name, object_name, offset=offset, length=length)
+        try:
+            yield from response.stream(chunk_size or self.download_chunk_size)
+        finally:
+            response.close()
+            response.release_conn()
+
+
+    def get_object_name(self, file_url) -> str:
+        '''
+        从保存在数据库中的文件地址（get_object_url的返回值）解析出对象名
+        '''
+        prefix = f'{self.url}/{self.bucket}/'
+        if file_url.startswith(prefix):
+            object_name = file_url[len(prefix):]
+        else:
+            object_name = urlparse(file_url).path.lstrip('/')
+            if object_name.startswith(f'{self.bucket}/'):
+                object_name = object_name[len(self.bucket) + 1:]
+        return unquote(object_name.split('?')[0])
 
 
-    def get_object_url(self, object_name, bucket_name=None, use_presigned=False, expires=timedelta(days=7)) -> str:
+    def get_object_url(self, object_name, bucket_name=None, use_presigned=False, expires=None) -> str:
         bucket_name = bucket_name or self.bucket
         if not use_presigned:
             file_url = f'{self.url}/{bucket_name}/{object_name}'
         else:
             try:
-                file_url = self.client.presigned_get_object(
-                    bucket_name, object_name, expires=expires)
+                file_url = self.get_presigned_url(object_name, bucket_name, expires or self.presigned_expires)
             except InvalidResponseError as e:
                 raise e
         return file_url
+
+
+    def get_object_urls(self, object_names, bucket_name=None, use_presigned=False, expires=None) -> list:
+        '''
+        批量获取文件地址，重复的对象名只签名一次
+        '''
+        urls = {}
+        for object_name in object_names:
+            if object_name not in urls:
+                urls[object_name] = self.get_object_url(object_name, bucket_name, use_presigned, expires)
+        return [urls[object_name] for object_name in object_names]
+
+
+    def get_presigned_window(self, expires: timedelta = None, now: float = None, with_size: bool = False):
+        '''
+        当前签名窗口的开始时间（秒），窗口 = 有效期 - 最少剩余有效期，同一窗口内的预签名地址相同
+        '''
+        expires_seconds = int((expires or self.presigned_expires).total_seconds())
+        min_remaining = self.presigned_min_remaining
+        if min_remaining is None:
+            min_remaining = expires_seconds // 2
+        elif isinstance(min_remaining, timedelta):
+            min_remaining = int(min_remaining.total_seconds())
+        window = max(expires_seconds - min_remaining, 1)
+        window_start = int((now if now is not None else time.time()) // window * window)
+        return (window_start, window) if with_size else window_start
+
+
+    def get_presigned_url(self, object_name, bucket_name, expires: timedelta) -> str:
+        '''
+        带缓存的预签名地址
+        签名时间向下取整到复用窗口（有效期 - 最少剩余有效期），同一窗口内的签名结果相同，
+        缓存到窗口结束，保证返回的地址至少还有presigned_min_remaining的有效期
+        '''
+        expires_seconds = int(expires.total_seconds())
+        now = time.time()
+        window_start, window = self.get_presigned_window(expires, now, with_size=True)
+        key = f'{bucket_name}/{object_name}/{expires_seconds}/{window_start}'
+        file_url = self.presigned_cache.get(key)
+        if file_url is None:
+            file_url = self.client.presigned_get_object(
+                bucket_name, object_name, expires=expires,
+                request_date=datetime.fromtimestamp(window_start, timezone.utc))
+            self.presigned_cache.set(key, file_url, ttl=window_start + window - now)
+        return file_url
@@ -3,7 +3,15 @@ from pydantic import BaseModel
 import importlib
 import inspect
 import copy
+import json
+import base64
+import csv
+import io
+import re
+import numbers
+from functools import lru_cache, cached_property
 from typing import List, Optional
+from pydantic import parse_obj_as
 
 
 def get_models_from_paths(model_file_paths) -> list:
@@ -21,9 +29,10 @@ def get_models_from_paths(model_file_paths) -> list:
     return models
 
 
+@lru_cache(maxsize=None)
 def get_fields_from_pydantic_model(m: BaseModel) -> dict:
     '''
-    从Pydantic模型中获取所有字段信息
+    从Pydantic模型中获取所有字段信息（按模型缓存，返回值只读）
     '''
     field_dict = {}
     if inspect.isclass(m) and issubclass(m, BaseModel):
@@ -51,13 +60,9 @@ def get_fields_flag_info_from_pydantic_model_by_flag(m: BaseModel, flag='x_uniqu
 
 def get_fields_name_from_pydantic_model_by_flag(m: BaseModel, flag='x_unique', *, reverse=False) -> list:
     '''
-    从Pydantic模型中获取，字段带/不带有flag标识的字段名
+    从Pydantic模型中获取，字段带/不带有flag标识的字段名（由模型元数据中的标识索引得到）
     '''
-    all_field_dict = get_fields_from_pydantic_model(m)
-    if reverse:
-        return [field for field, prop in all_field_dict.items() if flag not in prop]
-    else:
-        return [field for field, prop in all_field_dict.items() if flag in prop]
+    return get_model_meta(m).get_fields_name_by_flag(flag, reverse=reverse)
 
 
 def get_fields_name_from_pydantic_model(m: BaseModel) -> list:
@@ -68,6 +73,80 @@ def get_fields_name_from_pydantic_model(m: BaseModel) -> list:
     return [field for field, _ in all_field_dict.items()]
 
 
+class ModelMeta:
+    '''
+    模型元数据索引，每个模型只构建一次，派生模型在第一次使用时构建
+    '''
+    def __init__(self, m: BaseModel):
+        self.model = m
+        self.table_name = conv_under_line(m.__name__.split('.')[-1])
+        self.fields = get_fields_from_pydantic_model(m)
+        self.field_names = list(self.fields)
+        self.flags = {field: {k for k in prop if k.startswith('x_')} for field, prop in self.fields.items()}
+        self.flag_fields = {}   # (flag, reverse) -> 字段名，第一次查询时构建
+        self.foreign_keys = get_foreign_keys_from_pydantic_model(m)
+
+    @cached_property
+    def model_in(self) -> BaseModel:
+        return build_new_model_from_pydantic_model_by_flag(self.model, flag='x_in', suffix='_In')
+
+    @cached_property
+    def model_out(self) -> BaseModel:
+        if self.get_fields_name_by_flag('x_exclude_out'):
+            return build_new_model_from_pydantic_model_by_flag(self.model, flag='x_exclude_out', reverse=True, suffix='_Out')
+        return build_new_model_from_pydantic_model_by_flag(self.model, flag='x_out', suffix='_Out')
+
+    @cached_property
+    def model_query(self) -> BaseModel:
+        return build_new_model_from_pydantic_model_by_flag(self.model, flag='x_query', suffix='_Query', is_optional=True)
+
+    @cached_property
+    def model_put(self) -> BaseModel:
+        return build_new_model_from_pydantic_model_by_flag(self.model, flag='x_update', suffix='_Put', is_optional=True)
+
+    @cached_property
+    def model_file(self) -> BaseModel:
+        return build_new_model_from_pydantic_model_by_flag(self.model, flag='x_file', suffix='_File', is_optional=True)
+
+    @cached_property
+    def projection(self) -> dict:
+        return get_projection_from_pydantic_model(self.model_out)
+
+    @cached_property
+    def query_ops(self) -> dict:
+        return get_query_ops_from_pydantic_model(self.model)
+
+    @cached_property
+    def sort_fields(self) -> list:
+        return get_sort_fields_from_pydantic_model(self.model)
+
+    @cached_property
+    def search_fields(self) -> dict:
+        return get_search_fields_from_pydantic_model(self.model)
+
+    @cached_property
+    def stats_fields(self) -> tuple:
+        return get_stats_fields_from_pydantic_model(self.model)
+
+    @cached_property
+    def index_specs(self) -> list:
+        return get_index_specs_from_pydantic_model(self.model)
+
+    def get_fields_name_by_flag(self, flag='x_unique', *, reverse=False) -> list:
+        key = (flag, reverse)
+        if key not in self.flag_fields:
+            self.flag_fields[key] = tuple(field for field, flags in self.flags.items() if (flag in flags) != reverse)
+        return list(self.flag_fields[key])
+
+
+@lru_cache(maxsize=None)
+def get_model_meta(m: BaseModel) -> ModelMeta:
+    '''
+    获取模型的元数据索引（按模型缓存）
+    '''
+    return ModelMeta(m)
+
+
 def build_new_model_from_pydantic_model_by_flag(m: BaseModel, flag='x_in', *, reverse=False, suffix='In', is_optional=False):
     '''
     从旧模型中，将带/不带有flag标志的字段构建新模型
@@ -98,19 +177,421 @@ def has_flag_from_pydantic_model(m: BaseModel, flag='x_exclude_out', *, reverse=
     return bool(fields)
 
 
+def get_foreign_keys_from_pydantic_model(m: BaseModel) -> dict:
+    '''
+    获取模型的外键: {字段名: (关联表, 关联字段, 'one'/'list')}
+    x_foreign_key=('course', 'id', 'list') 或 x_foreign_key=('user', 'id')
+    '''
+    foreign_keys = {}
+    for field, info in get_fields_flag_info_from_pydantic_model_by_flag(m, flag='x_foreign_key').items():
+        table_name, key = info[0], info[1]
+        kind = info[2] if len(info) > 2 else 'one'
+        foreign_keys[field] = (table_name, key, kind)
+    return foreign_keys
+
+
+# 列表接口的过滤操作符: ?field__op=value
+QUERY_OPS = {
+    'eq': '$eq',
+    'ne': '$ne',
+    'gt': '$gt',
+    'gte': '$gte',
+    'lt': '$lt',
+    'lte': '$lte',
+    'in': '$in',
+    'nin': '$nin',
+    'exists': '$exists',
+    'prefix': '$regex',
+}
+DEFAULT_QUERY_OPS = ('eq', 'in', 'gt', 'gte', 'lt', 'lte')
+
+
+def get_query_ops_from_pydantic_model(m: BaseModel) -> dict:
+    '''
+    获取x_query字段（及id）允许的过滤操作符，{field: (ops, type_)}
+    默认只允许能走索引的等值、$in和范围查询，其他操作符需用x_query_ops声明，如Field(..., x_query=True, x_query_ops=['eq', 'prefix'])
+    '''
+    fields = get_fields_name_from_pydantic_model_by_flag(m, flag='x_query')
+    if 'id' in m.__fields__ and 'id' not in fields:
+        fields.insert(0, 'id')
+    ops_dict = get_fields_flag_info_from_pydantic_model_by_flag(m, flag='x_query_ops')
+    query_ops = {}
+    for field in fields:
+        ops = tuple(ops_dict.get(field, DEFAULT_QUERY_OPS))
+        type_ = m.__fields__[field].type_
+        unknown = [op for op in ops if op not in QUERY_OPS]
+        if unknown:
+            raise ValueError(f'{m.__name__}.{field}: 未知的过滤操作符: {unknown}')
+        if 'prefix' in ops and type_ is not str:
+            raise ValueError(f'{m.__name__}.{field}: prefix只能用于str字段')
+        query_ops[field] = (ops, type_)
+    return query_ops
+
+
+def build_query_filters(query_ops: dict, params: List[tuple]) -> tuple:
+    '''
+    将field__op形式的查询参数转为mongo查询条件，params: [(key, value), ...]
+    返回(查询条件, 不允许的参数列表, 值校验错误列表)
+    prefix转为锚定开头的正则（可以走索引），in/nin的值用逗号分隔或重复传参
+    '''
+    query, invalid, errors = {}, [], []
+    for key, value in params:
+        field, _, op = key.rpartition('__')
+        ops, type_ = query_ops.get(field, ((), None))
+        if op not in ops:
+            invalid.append(key)
+            continue
+        try:
+            if op in ('in', 'nin'):
+                v = [parse_obj_as(type_, x) for x in value.split(',') if x != '']
+                v = query.get(field, {}).get(QUERY_OPS[op], []) + v
+            elif op == 'exists':
+                v = parse_obj_as(bool, value)
+            elif op == 'prefix':
+                v = '^' + re.escape(value)
+            else:
+                v = parse_obj_as(type_, value)
+        except pydantic.ValidationError as e:
+            errors += [{'loc': ['query', key], 'msg': err['msg'], 'type': err['type']} for err in e.errors()]
+            continue
+        query.setdefault(field, {})[QUERY_OPS[op]] = v
+    return query, invalid, errors
+
+
+def get_sort_fields_from_pydantic_model(m: BaseModel) -> list:
+    '''
+    获取可排序的字段：id和带x_sort标识的字段
+    '''
+    fields = get_fields_name_from_pydantic_model_by_flag(m, flag='x_sort')
+    if 'id' in m.__fields__ and 'id' not in fields:
+        fields.insert(0, 'id')
+    return fields
+
+
+def parse_sort(sort: str, sort_fields: list) -> list:
+    '''
+    解析排序参数，如'-price,name'，-表示降序；不含id时追加id保证顺序唯一（游标分页需要）
+    非法时抛出ValueError
+    '''
+    keys = []
+    for item in sort.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        field, direction = (item[1:], -1) if item[0] == '-' else (item.lstrip('+'), 1)
+        if field not in sort_fields:
+            raise ValueError(f'不能排序的字段: {field}，可排序: {sort_fields}')
+        if field in (f for f, _ in keys):
+            raise ValueError(f'重复的排序字段: {field}')
+        keys.append((field, direction))
+    if not keys:
+        raise ValueError(f'非法的排序: {sort}')
+    if 'id' not in (f for f, _ in keys):
+        keys.append(('id', keys[-1][1]))
+    return keys
+
+
+def index_supports_sort(sort: list, index_specs: list, eq_fields=()) -> bool:
+    '''
+    判断是否有索引能直接提供该排序（不需要在内存中排序）
+    索引开头的字段被等值条件固定时可以跳过，排序需与索引剩余字段的前缀方向全部相同或全部相反
+    '''
+    sort = [tuple(key) for key in sort]
+    reverse = [(field, -direction) for field, direction in sort]
+    sort_fields = {field for field, _ in sort}
+    for spec in index_specs:
+        keys = [tuple(key) for key in spec['keys']]
+        while keys and keys[0][0] in eq_fields and keys[0][0] not in sort_fields:
+            keys = keys[1:]
+        if keys[:len(sort)] in (sort, reverse):
+            return True
+    return False
+
+
+def get_projection_from_pydantic_model(m: BaseModel) -> dict:
+    '''
+    根据模型字段构建数据库查询的投影，只读取接口需要返回的字段
+    '''
+    return get_projection_from_fields(get_fields_name_from_pydantic_model(m))
+
+
+STATS_OPS = {
+    'count': '$sum',
+    'sum': '$sum',
+    'avg': '$avg',
+    'min': '$min',
+    'max': '$max',
+}
+DEFAULT_METRIC_OPS = ('sum', 'avg', 'min', 'max')
+
+
+def get_stats_fields_from_pydantic_model(m: BaseModel) -> tuple:
+    '''
+    获取统计接口的字段，返回(可分组的字段列表, {可聚合的字段: 允许的聚合操作})
+    x_group=True的字段可以分组，x_metric=True或操作列表（如['sum', 'avg']）的字段可以聚合
+    x_metric=True时数值字段允许sum/avg/min/max，其他字段只允许min/max
+    '''
+    group_fields = get_fields_name_from_pydantic_model_by_flag(m, flag='x_group')
+    metric_ops = {}
+    for field, ops in get_fields_flag_info_from_pydantic_model_by_flag(m, flag='x_metric').items():
+        if not ops:
+            continue
+        type_ = m.__fields__[field].type_
+        is_number = inspect.isclass(type_) and issubclass(type_, numbers.Number)
+        if ops is True:
+            ops = DEFAULT_METRIC_OPS if is_number else ('min', 'max')
+        ops = tuple(ops)
+        unknown = [op for op in ops if op not in STATS_OPS or op == 'count']
+        if unknown:
+            raise ValueError(f'{m.__name__}.{field}: 未知的聚合操作: {unknown}')
+        if not is_number and ('sum' in ops or 'avg' in ops):
+            raise ValueError(f'{m.__name__}.{field}: sum/avg只能用于数值字段')
+        metric_ops[field] = ops
+    return group_fields, metric_ops
+
+
+def parse_stats(group_by: Optional[str], metric: Optional[str], group_fields: list, metric_ops: dict) -> tuple:
+    '''
+    解析统计参数，如group_by='level'，metric='count,sum:price,avg:price'，未传metric时只计数
+    返回(分组字段列表, [(结果字段名, 操作, 字段), ...])，非法时抛出ValueError
+    '''
+    keys = []
+    for field in (group_by or '').split(','):
+        field = field.strip()
+        if not field:
+            continue
+        if field not in group_fields:
+            raise ValueError(f'不能分组的字段: {field}，可分组: {group_fields}')
+        if field in keys:
+            raise ValueError(f'重复的分组字段: {field}')
+        keys.append(field)
+    metrics = []
+    for item in (metric or 'count').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        op, _, field = item.partition(':')
+        if op == 'count' and not field:
+            name = 'count'
+        elif field in metric_ops and op in metric_ops[field]:
+            name = f'{op}_{field}'
+        else:
+            allowed = ['count'] + [f'{op}:{field}' for field, ops in metric_ops.items() for op in ops]
+            raise ValueError(f'不支持的聚合: {item}，可用: {allowed}')
+        if name not in (n for n, _, _ in metrics):
+            metrics.append((name, op, field))
+    if not metrics:
+        raise ValueError(f'非法的聚合: {metric}')
+    return keys, metrics
+
+
+def build_stats_pipeline(query: dict, keys: list, metrics: list, limit: int = None) -> list:
+    '''
+    构建统计的聚合管道：$match过滤（可以走索引）后$group，只有聚合结果返回给调用方
+    '''
+    group = {'_id': {key: f'${key}' for key in keys} if keys else None}
+    for name, op, field in metrics:
+        group[name] = {STATS_OPS[op]: 1 if op == 'count' else f'${field}'}
+    pipeline = [{'$match': query}] if query else []
+    pipeline.append({'$group': group})
+    if keys:
+        pipeline.append({'$sort': {'_id': 1}})
+    if limit:
+        pipeline.append({'$limit': limit})
+    return pipeline
+
+
+def get_search_fields_from_pydantic_model(m: BaseModel) -> dict:
+    '''
+    获取全文搜索的字段及权重，x_search=True时权重为1，也可以直接给出权重，如Field(..., x_search=10)
+    '''
+    weights = {}
+    for field, weight in get_fields_flag_info_from_pydantic_model_by_flag(m, flag='x_search').items():
+        if weight is False or weight is None:
+            continue
+        if weight is True:
+            weight = 1
+        if not isinstance(weight, int) or weight < 1:
+            raise ValueError(f'{m.__name__}.{field}: x_search的权重需为正整数: {weight}')
+        weights[field] = weight
+    return weights
+
+
+def build_search_pipeline(q: str, query: dict, projection: dict = None, limit: int = None, after: dict = None) -> list:
+    '''
+    构建全文搜索的聚合管道：$text走文本索引，按相关度(_score)和id降序
+    after为上一页最后一条的{'_score', 'id'}，用于游标分页
+    '''
+    pipeline = [
+        {'$match': {'$text': {'$search': q}, **query}},
+        {'$addFields': {'_score': {'$meta': 'textScore'}}},
+    ]
+    if after is not None:
+        pipeline.append({'$match': {'$or': [
+            {'_score': {'$lt': after['_score']}},
+            {'_score': after['_score'], 'id': {'$lt': after['id']}},
+        ]}})
+    pipeline.append({'$sort': {'_score': -1, 'id': -1}})
+    if limit:
+        pipeline.append({'$limit': limit})
+    if projection:
+        pipeline.append({'$project': {**projection, 'id': True, '_score': True}})
+    return pipeline
+
+
+def get_projection_from_fields(fields: list) -> dict:
+    if not fields:
+        return {'_id': True}
+    return {'_id': False, **{field: True for field in fields}}
+
+
 def get_x_config_from_pydantic_model(m: BaseModel, attr='query'):
     '''
     从Pydantic的X_Config中获取属性
     '''
     if inspect.isclass(m) and issubclass(m, BaseModel):
+        x_config = getattr(m, 'X_Config', None)
+        if x_config is not None and hasattr(x_config, attr):
+            return getattr(x_config, attr)
         return getattr(m, attr) if hasattr(m, attr) else None
     return None
 
 
+def get_index_specs_from_pydantic_model(m: BaseModel, set_unique=True, set_foreign_key=True) -> list:
+    '''
+    根据模型字段标志和X_Config.indexes声明索引
+    id: 唯一索引; x_unique: 唯一索引; x_query/x_foreign_key: 普通索引; x_sort: (field, id)复合索引; x_search: 文本索引
+    X_Config.indexes: [[('a', 1), ('b', -1)], {'keys': [('c', 1)], 'unique': True}, ...]
+    '''
+    specs = {}
+
+    def add_index(keys, unique=False, **kwargs):
+        keys = tuple((field, direction) for field, direction in keys)
+        if keys in specs:
+            specs[keys]['unique'] = specs[keys]['unique'] or unique
+        else:
+            specs[keys] = {'keys': list(keys), 'unique': unique, **kwargs}
+
+    if 'id' in get_fields_name_from_pydantic_model(m):
+        add_index([('id', 1)], unique=True)
+    if set_unique:
+        for field in get_fields_name_from_pydantic_model_by_flag(m, flag='x_unique'):
+            add_index([(field, 1)], unique=True)
+    for field in get_fields_name_from_pydantic_model_by_flag(m, flag='x_query'):
+        add_index([(field, 1)])
+    for field in get_fields_name_from_pydantic_model_by_flag(m, flag='x_sort'):
+        add_index([(field, 1), ('id', 1)])
+    if set_foreign_key:
+        for field in get_fields_name_from_pydantic_model_by_flag(m, flag='x_foreign_key'):
+            add_index([(field, 1)])
+    search_fields = get_search_fields_from_pydantic_model(m)
+    if search_fields:   # 每个集合只能有一个文本索引，所有x_search字段合并为一个带权重的文本索引
+        add_index([(field, 'text') for field in search_fields], weights=search_fields)
+    for index in get_x_config_from_pydantic_model(m, attr='indexes') or []:
+        if isinstance(index, dict):
+            add_index(**index)
+        else:
+            add_index(index)
+    return list(specs.values())
+
+
 def conv_x_config_query(config):
     pass
 
 
+def encode_cursor(d: dict) -> str:
+    '''
+    将分页位置编码为不透明的游标字符串
+    '''
+    s = json.dumps(d, separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(s.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> dict:
+    '''
+    解码游标字符串，非法游标抛出ValueError
+    '''
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        d = json.loads(s)
+    except Exception as e:
+        raise ValueError(f'非法的游标: {cursor}') from e
+    if not isinstance(d, dict):
+        raise ValueError(f'非法的游标: {cursor}')
+    return d
+
+
+def parse_cursor_values(after: dict, m: BaseModel, fields: list) -> dict:
+    '''
+    游标以JSON保存，datetime等值会变成字符串，按模型字段的类型还原后才能与数据库中的值比较
+    非法时抛出ValueError
+    '''
+    values = dict(after)
+    for field in fields:
+        v = values.get(field)
+        if v is None or field not in m.__fields__:
+            continue
+        try:
+            values[field] = parse_obj_as(m.__fields__[field].outer_type_, v)
+        except ValueError as e:
+            raise ValueError(f'非法的游标: {field}={v}') from e
+    return values
+
+
+def dumps_ndjson(datas: list, fields: list) -> str:
+    '''
+    将数据按字段序列化为NDJSON，每行一条
+    '''
+    return ''.join(
+        json.dumps({f: d.get(f) for f in fields}, default=str, ensure_ascii=False) + '\n'
+        for d in datas
+    )
+
+
+def dumps_csv(datas: list, fields: list, header: bool = False) -> str:
+    '''
+    将数据按字段序列化为CSV，列表/字典类型的值序列化为JSON
+    '''
+    f = io.StringIO()
+    writer = csv.writer(f)
+    if header:
+        writer.writerow(fields)
+    for d in datas:
+        writer.writerow([
+            json.dumps(v, default=str, ensure_ascii=False) if isinstance(v, (list, dict)) else v
+            for v in (d.get(field) for field in fields)
+        ])
+    return f.getvalue()
+
+
+def parse_range_header(range_header: str, size: int) -> Optional[tuple]:
+    '''
+    解析单个HTTP Range（bytes=start-end、bytes=start-、bytes=-suffix），返回(start, end)，end包含在内
+    没有Range、格式不合法（如bytes=5-3、bytes=abc-）或多个区间时返回None（按RFC 7233忽略，返回完整内容）
+    格式合法但区间无法满足时（如起点超出文件大小）抛出ValueError
+    '''
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    match = re.fullmatch(r'([0-9]*)-([0-9]*)', spec.strip())
+    if match is None or not any(match.groups()):
+        return None
+    start, end = match.groups()
+    if start:
+        start = int(start)
+        if end and int(end) < start:
+            return None
+        end = min(int(end), size - 1) if end else size - 1
+    else:
+        start = max(size - int(end), 0)
+        end = size - 1 if int(end) else -1    # bytes=-0无法满足
+    if start > end:
+        raise ValueError(f'无法满足的Range: {range_header}')
+    return start, end
+
+
 def conv_under_line(s: str):
     ns = ''
     for i, c in enumerate(s):